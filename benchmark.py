@@ -0,0 +1,352 @@
+"""
+Benchmarks of the printer emulator.
+
+The jobs are made up here, with printtest.TestPrintJob, so their size and
+content can be chosen: how many pages and bands, the dpi, if the bands are
+compressed, and if they are blank or noisy.
+
+Each step of the emulator is timed on its own (packbits decoding, command
+parsing, with and without decoding the bands, command evaluation, band
+plotting), and then the whole rendering.
+The results can be saved as JSON, and compared with the ones of an older
+version.
+"""
+
+import argparse
+import io
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from printtest import TestPrintJob
+
+from epsonserver import (CommandLexer, PackBitsDecoder, PrinterState, RenderOptions,
+                         TRACE_OFF, band_from_state, eval_command,
+                         parse_until_enable_printing, render_job, set_trace)
+
+
+# The ink colors the driver uses, in the order it sends them
+COLORS = (0, 2, 1, 4)
+
+
+def encode_packbits(data: bytes) -> bytes:
+    """
+    Compress 'data' the way the printer driver does: runs of 3 to 128 equal
+    bytes become a count and the byte, and the rest goes as literals.
+
+    (printtest.pack_byte_encode only does runs, and with the wrong count.)
+    """
+    out = bytearray()
+    literal = bytearray()
+    i = 0
+    while i < len(data):
+        run = 1
+        while i+run < len(data) and run < 128 and data[i+run] == data[i]:
+            run += 1
+
+        if run >= 3:
+            while literal:
+                out.append(min(len(literal), 128) - 1)
+                out += literal[:128]
+                del literal[:128]
+
+            out += bytes([257-run, data[i]])
+            i += run
+        else:
+            literal += data[i:i+run]
+            i += run
+
+    while literal:
+        out.append(min(len(literal), 128) - 1)
+        out += literal[:128]
+        del literal[:128]
+
+    return bytes(out)
+
+
+class SyntheticJob(TestPrintJob):
+    """
+    A print job of 'pages' pages with 'bands' bands each, in the size
+    printtest.TestPrintJob prints them (60 lines of 288 bytes, 2 bits per
+    dot), two bands side by side.
+
+    'content' is "blank" (no dots), "noisy" (random dots) or "mixed"
+    (random runs of dots and blanks, like a real page).
+    """
+
+    BYTES_PER_ROW = 288
+    LINES = 60
+    BPP = 2
+
+    def __init__(self, pages: int = 1, bands: int = 64, dpi: int = 360,
+                 compress: bool = True, content: str = "mixed", seed: int = 0):
+        super().__init__(None, dpi)
+        self.random = random.Random(seed)
+
+        # The compressed data of each band
+        self.packed = []
+
+        self.add_metadata_commands()
+        for page in range(pages):
+            for band in range(bands):
+                self.buffer += self.move_horizontal(1 + 82*(band % 2))
+                self.buffer += self.print_band(self.band_data(content),
+                                               COLORS[band % len(COLORS)], compress)
+                self.buffer += b"\r"
+                if band % 2 == 1:
+                    self.buffer += self.advance_vertical(self.vunit_to_mm(self.LINES))
+
+            self.buffer += self.end_page()
+
+        self.create_epilogue()
+
+    def band_data(self, content: str) -> bytes:
+        size = self.BYTES_PER_ROW * self.LINES
+        if content == "blank":
+            return bytes(size)
+        elif content == "noisy":
+            return self.random.randbytes(size)
+
+        data = bytearray()
+        while len(data) < size:
+            run = self.random.randrange(1, 200)
+            if self.random.random() < 0.5:
+                data += bytes([self.random.choice((0x00, 0x55, 0xaa, 0xff))]) * run
+            else:
+                data += self.random.randbytes(run)
+
+        return bytes(data[:size])
+
+    def print_band(self, data: bytes, color: int, compress: bool) -> bytes:
+        """
+        Like print_data, but with any bytes, compressed or not
+        """
+        return b"\x1bi" + self._encode_num_as_bytes(color) + \
+            self._encode_num_as_bytes(1 if compress else 0) + \
+            self._encode_num_as_bytes(self.BPP) + \
+            self._encode_num_as_bytes(self.BYTES_PER_ROW, 2) + \
+            self._encode_num_as_bytes(self.LINES, 2) + \
+            (self.pack(data) if compress else data)
+
+    def pack(self, data: bytes) -> bytes:
+        self.packed.append(encode_packbits(data))
+        return self.packed[-1]
+
+
+def timed(func, warmup: int, repeat: int) -> list:
+    """
+    Run 'func' 'warmup' times, and then return how long each of 'repeat'
+    more runs took
+    """
+    for _ in range(warmup):
+        func()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def job_commands(job: bytes) -> tuple:
+    """
+    Return the start of the job commands, the commands, and the bands
+    placed on the page, with the page size
+    """
+    lexer = job_lexer(job)
+    start = lexer.pos
+    commands = list(lexer)
+
+    state = PrinterState()
+    bands = []
+    for cmd in commands:
+        state = eval_command(cmd, state)
+        if state.printing is True:
+            state.printing = False
+            bands.append(band_from_state(state, cmd.payload))
+
+    return start, commands, bands, (state.pagelen, state.pagewidth)
+
+
+def job_lexer(job: bytes) -> CommandLexer:
+    """
+    Return a lexer for the commands after the printing preamble of 'job'
+    """
+    stream = io.BytesIO(job)
+    parse_until_enable_printing(stream)
+    return CommandLexer(job, pos=stream.tell())
+
+
+def run_benchmarks(synthetic: SyntheticJob, warmup: int, repeat: int,
+                   jobs: int = 1) -> dict:
+    """
+    Time each step of the emulator on a job. Returns, for each benchmark,
+    how many operations it did and how many bytes it went through, on each
+    run, and how long the runs took.
+    """
+    from epsonraster import new_page, plot_to_image
+
+    job = synthetic.buffer
+    packed = synthetic.packed
+    start, commands, bands, pagesize = job_commands(job)
+    unpacked = sum(len(band.data) for band in bands)
+    bandsize = synthetic.BYTES_PER_ROW * synthetic.LINES
+
+    # The decoder the lexer uses, on each band
+    def decode():
+        for data in packed:
+            PackBitsDecoder(bandsize).feed(data)
+
+    def parse():
+        for _ in CommandLexer(job, pos=start, decode=False):
+            pass
+
+    def parse_decode():
+        for _ in CommandLexer(job, pos=start):
+            pass
+
+    def evaluate():
+        state = PrinterState()
+        for cmd in commands:
+            state = eval_command(cmd, state)
+            state.printing = False
+
+    def plot():
+        planes = new_page(*pagesize)
+        for band in bands:
+            plot_to_image(planes, band.x, band.y, band.width, band.height,
+                          band.color, band.data, band.bpp)
+
+    options = RenderOptions(jobs=jobs)
+    pages = sum(1 for _ in render_job(job, options))
+
+    def render():
+        for _ in render_job(job, options):
+            pass
+
+    benchmarks = dict(
+        decode_packbits=(decode, len(packed), sum(map(len, packed))),
+        parse=(parse, len(commands), len(job) - start),
+        parse_decode=(parse_decode, len(commands), len(job) - start),
+        eval_command=(evaluate, len(commands), len(job) - start),
+        plot_to_image=(plot, len(bands), unpacked),
+        render=(render, pages, len(job)),
+    )
+
+    results = {}
+    for name, (func, ops, size) in benchmarks.items():
+        if ops == 0:
+            continue
+
+        times = timed(func, warmup, repeat)
+        best = min(times)
+        results[name] = dict(
+            ops=ops, bytes=size, times=times,
+            ops_per_s=ops / best, mb_per_s=size / best / 1e6,
+        )
+        print("{:<16} {:>12.1f} ops/s {:>10.1f} MB/s   (best of {}: {:.4f} s, "
+              "median {:.4f} s)".format(name, ops / best, size / best / 1e6,
+                                        repeat, best, statistics.median(times)))
+
+    return results
+
+
+def version() -> str:
+    """
+    The commit being benchmarked, if this is a git checkout
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              capture_output=True, text=True,
+                              cwd=sys.path[0] or ".").stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, path: str):
+    """
+    Print how much faster (or slower) each benchmark is than on 'path'
+    """
+    with open(path) as old:
+        before = json.load(old)
+
+    print("\nCompared to {} ({}):".format(path, before.get("version", "?")))
+    for name, result in results.items():
+        if name not in before["results"]:
+            continue
+
+        ratio = result["ops_per_s"] / before["results"][name]["ops_per_s"]
+        print("{:<16} {:>8.2f}x {}".format(name, ratio,
+                                           "" if ratio > 0.95 else "SLOWER"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the printer emulator on a made up job")
+    parser.add_argument("--pages", type=int, default=2,
+                        help="pages on the job (default: 2)")
+    parser.add_argument("--bands", type=int, default=64,
+                        help="bands on each page (default: 64)")
+    parser.add_argument("--dpi", type=int, default=360,
+                        help="job resolution (default: 360)")
+    parser.add_argument("--uncompressed", action="store_true",
+                        help="send the bands without packbits compression")
+    parser.add_argument("--content", choices=("blank", "noisy", "mixed"),
+                        default="mixed",
+                        help="what the bands have (default: mixed)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the noise (default: 0)")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="runs before the ones timed (default: 1)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs timed (default: 5)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="rasterize each page on this many processes, "
+                             "when rendering (default: 1)")
+    parser.add_argument("--save-job", metavar="PATH",
+                        help="also save the job, to be rendered by "
+                             "epsonserver.py")
+    parser.add_argument("-o", "--output", metavar="PATH",
+                        help="save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare the results with the ones saved on PATH")
+    args = parser.parse_args()
+
+    set_trace(TRACE_OFF)
+
+    config = dict(pages=args.pages, bands=args.bands, dpi=args.dpi,
+                  compress=not args.uncompressed, content=args.content,
+                  seed=args.seed, warmup=args.warmup, repeat=args.repeat,
+                  jobs=args.jobs)
+
+    synthetic = SyntheticJob(args.pages, args.bands, args.dpi, not args.uncompressed,
+                             args.content, args.seed)
+    job = synthetic.buffer
+    print("Job: {} bytes, {} pages of {} bands, {} dpi, {}, {}".format(
+        len(job), args.pages, args.bands, args.dpi,
+        "uncompressed" if args.uncompressed else "compressed", args.content))
+
+    if args.save_job is not None:
+        with open(args.save_job, "wb") as out:
+            out.write(job)
+
+    results = run_benchmarks(synthetic, args.warmup, args.repeat, args.jobs)
+
+    if args.output is not None:
+        with open(args.output, "w") as out:
+            json.dump(dict(version=version(), python=platform.python_version(),
+                           machine=platform.machine(), config=config,
+                           results=results), out, indent=2)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,929 @@
+"""
+Rasterization of the bands of an Epson print job, for epsonserver.py
+
+It is kept apart from the emulator, so going through a job without drawing it
+does not load numpy and PIL.
+"""
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from multiprocessing import shared_memory
+from typing import Iterator, Optional
+
+from PIL import Image
+
+import numpy as np
+
+
+# min and max values for each cartridge
+INK_VALUES = [
+    ["#000000", "#ffffff"], # black
+    ["#ff00ff", "#ffffff"], # magenta
+    ["#00ffff", "#ffffff"], # cyan
+    ["#000000", "#ffffff"], # ????
+    ["#ffff00", "#ffffff"], # yellow
+    ["#111111", "#ffffff"], # alternate black
+    ["#222222", "#ffffff"], # alternate black
+]
+
+
+def split_color(colorhex):
+    colorhex = colorhex.replace("#", "")
+    r, g, b = (colorhex[0:2], colorhex[2:4], colorhex[4:6])
+
+    return [int(r, 16), int(g, 16), int(b, 16)]
+
+
+def generate_color(hexmin, hexmax, proportion):
+    cmin = split_color(hexmin)
+    cmax = split_color(hexmax)
+    pinv = 1-proportion
+
+    return [
+        int(cmin[0]*proportion + cmax[0]*pinv),
+        int(cmin[1]*proportion + cmax[1]*pinv),
+        int(cmin[2]*proportion + cmax[2]*pinv)
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def ink_table(inkcolor: int, bpp: int) -> np.ndarray:
+    """
+    Return how much a dot of each possible value darkens the paper, for
+    the ink 'inkcolor' at 'bpp' bits per dot.
+
+    Row N of the table is the (r, g, b) amount subtracted from the paper by
+    a dot of value N.
+    """
+    cartridge = INK_VALUES[inkcolor]
+    maxvalue = (1 << bpp) - 1
+
+    table = np.empty((maxvalue+1, 3), dtype=np.uint8)
+    for value in range(maxvalue+1):
+        color = generate_color(cartridge[0], cartridge[1], value / maxvalue)
+        table[value] = [255-color[0], 255-color[1], 255-color[2]]
+
+    return table
+
+
+# The ink coverage planes of a page. Cyan, magenta and yellow take away red,
+# green and blue, and black takes away all of them.
+PLANES = "CMYK"
+PLANE_K = 3
+
+
+@functools.lru_cache(maxsize=None)
+def ink_coverage(inkcolor: int, bpp: int) -> np.ndarray:
+    """
+    Return how much a dot of each possible value of the ink 'inkcolor', at
+    'bpp' bits per dot, covers each of the C, M, Y and K planes.
+
+    Row N of the table is the coverage of plane N. What a dot takes from all
+    channels goes to K, and the rest to the plane of each channel, so the
+    coverage on a channel plus the K coverage is what ink_table takes from
+    it.
+    """
+    table = ink_table(inkcolor, bpp)
+    black = table.min(axis=1)
+
+    return np.vstack((table.T - black, black))
+
+
+@functools.lru_cache(maxsize=None)
+def dot_table(bpp: int) -> np.ndarray:
+    """
+    Return the values of the dots packed in each possible byte, at 'bpp'
+    bits per dot.
+
+    Entry N of the table has the 8/bpp dots of byte N, one per byte, packed
+    into a single integer, so a band is unpacked with a single lookup per
+    byte (view the result as bytes to get the dots). The first dot is on the
+    lowest bits.
+    """
+    if bpp not in (1, 2, 4, 8):
+        raise RuntimeError(f"bpp {bpp} not handled!")
+
+    shifts = np.arange(0, 8, bpp, dtype=np.uint8)
+    dots = (np.arange(256, dtype=np.uint8)[:, None] >> shifts) & ((1 << bpp) - 1)
+
+    table = dots.view(np.dtype("u{}".format(8 // bpp))).ravel()
+    table.flags.writeable = False
+    return table
+
+
+def unpack_dots(buf: bytes, bpp: int, width: int, height: int, rows: slice,
+                cols: slice):
+    """
+    Unpack the dots of a band of 'height' rows of 'width' dots, returning the
+    value of the dots in 'rows' and 'cols'.
+
+    Each row starts on a byte of its own, so a row of dots that does not
+    fill its last byte is padded.
+
+    The band might not have data for all of its dots. We also return a mask
+    of the dots it has data for, or None if it has all of them.
+    """
+    table = dot_table(bpp)
+    dotsbyte = 8 // bpp
+    bytesline = -(-width // dotsbyte)
+
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    valid = None
+    if raw.size < bytesline*height:
+        rowstart = np.arange(rows.start, rows.stop)[:, None] * bytesline
+        valid = rowstart + np.arange(cols.start, cols.stop) // dotsbyte < raw.size
+        raw = np.concatenate((raw, np.zeros(bytesline*height - raw.size,
+                                            dtype=np.uint8)))
+
+    firstbyte = cols.start // dotsbyte
+    lastbyte = -(-cols.stop // dotsbyte)
+    packed = raw[:bytesline*height].reshape(height, bytesline)[rows, firstbyte:lastbyte]
+
+    if bpp == 8:
+        dots = packed
+    else:
+        dots = table[packed].view(np.uint8).reshape(packed.shape[0], -1)
+
+    skip = cols.start - firstbyte*dotsbyte
+    return dots[:, skip:skip + cols.stop - cols.start], valid
+
+
+def _inside(coords: np.ndarray, size: int) -> np.ndarray:
+    """
+    Return the indices of the coordinates that land inside an image axis of
+    'size' pixels.
+
+    PIL wraps negative coordinates around, like python sequences do, and
+    raises IndexError on anything else outside of the image (and we skip
+    those dots), so we emulate that.
+    """
+    return np.flatnonzero((coords >= -size) & (coords < size))
+
+
+def _positions(coords: np.ndarray, size: int):
+    """
+    Return where some evenly spaced coordinates, all inside an image axis of
+    'size' pixels, land on it.
+
+    This is a slice if they do not wrap around, and an index array otherwise.
+    """
+    first = int(coords[0])
+    last = int(coords[-1])
+    if first >= 0 or last < 0:
+        step = int(coords[1] - coords[0]) if len(coords) > 1 else 1
+        first %= size
+        return slice(first, first + step*(len(coords)-1) + 1, step)
+
+    return coords % size
+
+
+def _plot_dots(planes: np.ndarray, touched: np.ndarray, ink: np.ndarray, valid,
+               evenrows: np.ndarray, oddrows: np.ndarray, colpos: slice):
+    """
+    Add 'ink' to the 'touched' planes, on the rows 'evenrows', and copy all
+    the planes of those rows to the rows 'oddrows', in the columns 'colpos'.
+
+    The even rows must land inside the page, the odd rows that do not are
+    not copied. No two dots can land on the same pixel.
+    """
+    pageheight = planes.shape[1]
+    rows = _positions(evenrows, pageheight)
+    even = (slice(None), rows, colpos)
+
+    # emulate printing on paper: the ink piles up until it covers it all.
+    # The dots we have no data for are 0, so they add nothing.
+    printed = planes[even]
+    for plane, planeink in zip(touched, ink):
+        paper = printed[plane]
+        paper += np.minimum(255 - paper, planeink)
+
+    # Without wrapped rows, 'printed' is a view, and already on the page
+    if not isinstance(rows, slice):
+        planes[even] = printed
+
+    copied = (oddrows >= -pageheight) & (oddrows < pageheight)
+    if not copied.any():
+        return
+
+    odd = (slice(None), _positions(oddrows[copied], pageheight), colpos)
+    printed = printed[:, copied]
+    if valid is not None:
+        printed = np.where(valid[copied], printed, planes[odd])
+
+    planes[odd] = printed
+
+
+def band_raster(buf: bytes, inkcolor: int, bpp: int, width: int, height: int,
+                rows: slice, cols: slice):
+    """
+    Return which planes the dots in 'rows' and 'cols' of a band cover, how
+    much they cover each of them, and the mask of the dots we have data for
+    (as in unpack_dots).
+    """
+    coverage = ink_coverage(inkcolor, bpp)
+    dots, valid = unpack_dots(buf, bpp, width, height, rows, cols)
+
+    # Most inks cover a single plane
+    touched = np.flatnonzero(coverage.any(axis=1))
+    return touched, coverage[touched][:, dots], valid
+
+
+# How much memory the band rasters of a BandCache can take, by default
+BAND_CACHE_SIZE = 64 << 20
+
+
+class BandCache:
+    """
+    Memory cache of band rasters, so the bands that repeat are not unpacked
+    again.
+
+    The rasters are keyed by the hash of the band data, and the color, bpp,
+    and size of the band. The least recently used ones are dropped when they
+    take more than 'size' bytes.
+    """
+
+    def __init__(self, size: int = BAND_CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.rasters = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def raster(self, buf: bytes, inkcolor: int, bpp: int, width: int,
+               height: int):
+        """
+        Return the band_raster of all the dots of a band
+        """
+        key = (hashlib.blake2b(buf, digest_size=16).digest(), inkcolor, bpp,
+               width, height)
+
+        with self.lock:
+            raster = self.rasters.get(key)
+            if raster is not None:
+                self.rasters.move_to_end(key)
+                self.hits += 1
+                return raster
+
+            self.misses += 1
+
+        raster = band_raster(buf, inkcolor, bpp, width, height,
+                             slice(0, height), slice(0, width))
+        for array in raster[1:]:
+            if array is not None:
+                array.flags.writeable = False
+
+        size = sum(array.nbytes for array in raster if array is not None)
+        if size > self.size:
+            return raster
+
+        with self.lock:
+            if key not in self.rasters:
+                self.rasters[key] = raster
+                self.used += size
+
+            while self.used > self.size:
+                _, old = self.rasters.popitem(last=False)
+                self.used -= sum(array.nbytes for array in old if array is not None)
+
+        return raster
+
+
+def plot_to_image(planes: np.ndarray, imgx: int, imgy: int, width: int,
+                  height: int, inkcolor: int, buf: bytes, bpp: int,
+                  pagewidth: Optional[int] = None, left: int = 0,
+                  cache: Optional[BandCache] = None) -> np.ndarray:
+    """
+    Plot an to-be-printed image, from the buffer 'buf' into 'planes',
+    in the specified position, and using the specified inkcolor.
+
+    'planes' are the (4, height, width) C, M, Y and K coverage planes of a
+    page. Each row of the band is plotted on two consecutive rows of them.
+
+    'planes' can also be a vertical stripe of the page: the columns from
+    'left' on, of a page 'pagewidth' columns wide. Only the dots that land
+    on the stripe are plotted.
+
+    With a 'cache', the raster of the band is taken from it, when the same
+    band was plotted before.
+    """
+    width = int(width)
+    height = int(height)
+    pageheight = planes.shape[1]
+    if pagewidth is None:
+        pagewidth = planes.shape[2]
+
+    if width <= 0 or height <= 0:
+        return planes
+
+    if pageheight == 0 or pagewidth == 0:
+        return planes
+
+    # The band columns that land on the stripe. The ones that wrap around
+    # from negative coordinates come first, as PIL plots them first.
+    right = left + planes.shape[2]
+    colparts = []
+    for start, stop in ((left - pagewidth, right - pagewidth), (left, right)):
+        start = max(start - imgx, 0)
+        stop = min(stop - imgx, width)
+        if start < stop:
+            colparts.append((start, stop))
+
+    evenrows = imgy + 2*np.arange(height)
+    bandrows = _inside(evenrows, pageheight)
+    if not colparts or bandrows.size == 0:
+        return planes
+
+    rows = slice(int(bandrows[0]), int(bandrows[-1]) + 1)
+    cols = slice(colparts[0][0], colparts[-1][1])
+    if cache is None:
+        touched, ink, valid = band_raster(buf, inkcolor, bpp, width, height,
+                                          rows, cols)
+    else:
+        touched, ink, valid = cache.raster(buf, inkcolor, bpp, width, height)
+        ink = ink[:, rows, cols]
+        if valid is not None:
+            valid = valid[rows, cols]
+
+    # Every row but the last is copied to the image row below it
+    evenrows = evenrows[rows]
+    oddrows = evenrows + 1
+    if rows.stop == height:
+        oddrows[-1] = pageheight
+
+    parts = []
+    for start, stop in colparts:
+        first = (imgx + start) % pagewidth - left
+        parts.append((slice(start - cols.start, stop - cols.start),
+                      slice(first, first + stop - start)))
+
+    if width <= pagewidth and 2*height-1 <= pageheight:
+        for bandcols, colpos in parts:
+            _plot_dots(planes, touched, ink[:, :, bandcols],
+                       valid[:, bandcols] if valid is not None else None,
+                       evenrows, oddrows, colpos)
+
+        return planes
+
+    # The band is bigger than the page, so some of its dots wrap around to
+    # the same pixels. Plot them in the order PIL would.
+    for row in range(len(evenrows)):
+        band = slice(row, row+1)
+        for bandcols, colpos in parts:
+            _plot_dots(planes, touched, ink[:, band, bandcols],
+                       valid[band, bandcols] if valid is not None else None,
+                       evenrows[band], oddrows[band], colpos)
+
+    return planes
+
+
+def plot_band(planes: np.ndarray, band, pagewidth: Optional[int] = None,
+              left: int = 0, cache: Optional[BandCache] = None) -> np.ndarray:
+    """
+    Plot a Band of the emulator on the page
+    """
+    return plot_to_image(planes, band.x, band.y, band.width, band.height,
+                         band.color, band.data, band.bpp, pagewidth, left,
+                         cache)
+
+
+# How much smaller than the page a preview can be, on each side
+PREVIEW_SCALES = (2, 4, 8)
+
+
+def preview_size(pagelen: int, pagewidth: int, scale: int) -> tuple[int, int]:
+    """
+    Return the size of the preview of a page, 'scale' times smaller on each
+    side
+    """
+    return -(-pagelen // scale), -(-pagewidth // scale)
+
+
+def plot_preview(planes: np.ndarray, band, scale: int,
+                 cache: Optional[BandCache] = None) -> np.ndarray:
+    """
+    Plot a Band of the emulator on the preview of a page, 'scale' times
+    smaller than the page on each side (see preview_size).
+
+    Each pixel of the preview gets the average coverage of the band on the
+    'scale' x 'scale' pixels of the page it stands for. The bands are
+    filtered one at a time, so where they overlap the inks pile up a little
+    differently than on the page, and the rows are not copied down the way
+    plot_to_image does.
+    """
+    width = int(band.width)
+    height = int(band.height)
+    pageheight, pagewidth = planes.shape[1:]
+    if width <= 0 or height <= 0 or pageheight == 0 or pagewidth == 0:
+        return planes
+
+    # The dots with no data are 0, and add nothing
+    if cache is None:
+        touched, ink, _ = band_raster(band.data, band.color, band.bpp, width,
+                                      height, slice(0, height), slice(0, width))
+    else:
+        touched, ink, _ = cache.raster(band.data, band.color, band.bpp, width,
+                                       height)
+
+    # The preview row and column each row and column of the band lands on,
+    # and where each run of them landing on the same one starts
+    rows = (band.y + 2*np.arange(height)) // scale
+    cols = (band.x + np.arange(width)) // scale
+    rowstarts = np.flatnonzero(np.diff(rows, prepend=rows[0] - 1))
+    colstarts = np.flatnonzero(np.diff(cols, prepend=cols[0] - 1))
+
+    summed = np.add.reduceat(ink, rowstarts, axis=1, dtype=np.uint32)
+    summed = np.add.reduceat(summed, colstarts, axis=2)
+
+    # Each row of the band covers two rows of the page
+    box = (summed * 2 // (scale*scale)).astype(np.uint8)
+
+    # Like on the page, negative coordinates wrap around, and the ones past
+    # the end are left out
+    rows = rows[rowstarts]
+    cols = cols[colstarts]
+    rowsin = (rows >= -pageheight) & (rows < pageheight)
+    colsin = (cols >= -pagewidth) & (cols < pagewidth)
+    if not rowsin.any() or not colsin.any():
+        return planes
+
+    box = box[:, rowsin][:, :, colsin]
+    where = np.ix_(touched, rows[rowsin] % pageheight, cols[colsin] % pagewidth)
+
+    paper = planes[where]
+    paper += np.minimum(255 - paper, box)
+    planes[where] = paper
+
+    return planes
+
+
+# Pages with planes bigger than this are drawn on a temporary file, instead of
+# in memory
+PAGE_MEMORY_LIMIT = 256 << 20
+
+
+def new_page(pagelen: int, pagewidth: int,
+             limit: Optional[int] = None) -> np.ndarray:
+    """
+    Return the coverage planes of a blank page.
+
+    If they take more than 'limit' bytes (PAGE_MEMORY_LIMIT by default),
+    they are mapped from a temporary file, so only the parts being drawn
+    need to be in memory.
+    """
+    if _on_disk(pagelen, pagewidth, limit):
+        page, path = _file_page(pagelen, pagewidth)
+        os.unlink(path)
+        return page
+
+    return np.zeros((len(PLANES), pagelen, pagewidth), dtype=np.uint8)
+
+
+def _on_disk(pagelen: int, pagewidth: int, limit: Optional[int]) -> bool:
+    if limit is None:
+        limit = PAGE_MEMORY_LIMIT
+
+    return len(PLANES)*pagelen*pagewidth > limit
+
+
+def _file_page(pagelen: int, pagewidth: int):
+    """
+    Map the planes of a blank page from a new temporary file (on TMPDIR), and
+    return them and the path of the file.
+
+    The file is sparse, so it only takes disk space where we draw.
+    """
+    size = len(PLANES)*pagelen*pagewidth
+    fd, path = tempfile.mkstemp(prefix="epsonpage-")
+    try:
+        os.ftruncate(fd, size)
+        mapped = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+    page = np.ndarray((len(PLANES), pagelen, pagewidth), dtype=np.uint8,
+                      buffer=mapped)
+    return page, path
+
+
+def composite(planes: np.ndarray) -> np.ndarray:
+    """
+    Turn the coverage planes of a page into a (height, width, 3) RGB image
+    """
+    image = np.empty(planes.shape[1:] + (3,), dtype=np.uint8)
+    black = planes[PLANE_K]
+
+    # The same subtraction a dot of ink does on paper
+    for channel in range(3):
+        paper = 255 - planes[channel]
+        paper -= np.minimum(paper, black)
+        image[..., channel] = paper
+
+    return image
+
+
+# How many stripes each process rasterizes, on average. More stripes even the
+# load out, but every stripe goes through every band.
+STRIPES_PER_JOB = 2
+
+
+def _plot_stripe(pagename: str, dataname: str, pagelen: int, pagewidth: int,
+                 left: int, right: int, bands, pagefile: bool = False):
+    """
+    Plot the columns 'left' to 'right' of a shared page, on a worker process.
+
+    'bands' are (x, y, width, height, color, bpp, offset, size) tuples. The
+    data of each band is at 'offset' on the shared 'dataname' buffer.
+
+    The page is on the shared memory 'pagename', or on the file 'pagename'
+    if 'pagefile' is set.
+    """
+    pageshm = None if pagefile else shared_memory.SharedMemory(pagename)
+    datashm = shared_memory.SharedMemory(dataname)
+
+    try:
+        shape = (len(PLANES), pagelen, pagewidth)
+        if pagefile:
+            page = np.memmap(pagename, dtype=np.uint8, mode="r+", shape=shape)
+        else:
+            page = np.ndarray(shape, dtype=np.uint8, buffer=pageshm.buf)
+
+        stripe = page[:, :, left:right]
+
+        for x, y, width, height, color, bpp, offset, size in bands:
+            plot_to_image(stripe, x, y, width, height, color,
+                          datashm.buf[offset:offset+size], bpp, pagewidth, left)
+
+        del page, stripe
+    finally:
+        if pageshm is not None:
+            pageshm.close()
+        datashm.close()
+
+
+def _stripe_bounds(pagewidth: int, bands, count: int) -> list:
+    """
+    Split the page columns in 'count' stripes with about the same amount of
+    dots to plot.
+    """
+    work = np.zeros(pagewidth + 1)
+    for band in bands:
+        start = min(max(band.x, 0), pagewidth)
+        stop = min(max(band.x + band.width, 0), pagewidth)
+        work[start] += band.height
+        work[stop] -= band.height
+
+    work = np.cumsum(work[:-1]) + 1
+    total = np.cumsum(work)
+    cuts = np.searchsorted(total, total[-1] * np.arange(1, count) / count)
+
+    bounds = sorted(set([0, pagewidth] + [int(c) for c in cuts]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def rasterize_parallel(pagelen: int, pagewidth: int, bands, executor,
+                       stripes: int, limit: Optional[int] = None) -> np.ndarray:
+    """
+    Plot the bands of a page on the worker processes of 'executor'.
+
+    Each process plots a vertical stripe of the page. Dots never move to other
+    columns, so the stripes do not depend on each other and the page is the
+    same one plotting the bands one by one would give.
+
+    Pages bigger than 'limit' are shared through a temporary file, as in
+    new_page.
+    """
+    if _on_disk(pagelen, pagewidth, limit):
+        page, path = _file_page(pagelen, pagewidth)
+        try:
+            _rasterize_shared(path, True, pagelen, pagewidth, bands,
+                              executor, stripes)
+        finally:
+            os.unlink(path)
+
+        return page
+
+    pageshm = shared_memory.SharedMemory(create=True,
+                                         size=max(len(PLANES)*pagelen*pagewidth, 1))
+    try:
+        shared = np.ndarray((len(PLANES), pagelen, pagewidth), dtype=np.uint8,
+                            buffer=pageshm.buf)
+        shared.fill(0)
+
+        _rasterize_shared(pageshm.name, False, pagelen, pagewidth, bands,
+                          executor, stripes)
+
+        page = shared.copy()
+        del shared
+    finally:
+        pageshm.close()
+        pageshm.unlink()
+
+    return page
+
+
+def _rasterize_shared(pagename: str, pagefile: bool, pagelen: int,
+                      pagewidth: int, bands, executor, stripes: int):
+    """
+    Plot the bands on the stripes of a page shared as 'pagename'
+    """
+    size = sum(len(band.data) for band in bands)
+    datashm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+    try:
+        records = []
+        offset = 0
+        for band in bands:
+            size = len(band.data)
+            datashm.buf[offset:offset+size] = band.data
+            records.append((band.x, band.y, band.width, band.height, band.color,
+                            band.bpp, offset, size))
+            offset += size
+
+        if pagelen > 0 and pagewidth > 0:
+            futures = [
+                executor.submit(_plot_stripe, pagename, datashm.name,
+                                pagelen, pagewidth, left, right, records,
+                                pagefile)
+                for left, right in _stripe_bounds(pagewidth, bands, stripes)
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        datashm.close()
+        datashm.unlink()
+
+
+# How many rows of a page we turn into PNG at a time, when we stream it
+PNG_STRIP_ROWS = 64
+
+# How much the PNG images are compressed, by default (0 to 9)
+PNG_LEVEL = 6
+
+# TIFF images bigger than this are saved as BigTIFF, with 64 bit offsets
+TIFF_LIMIT = (1 << 32) - (1 << 20)
+
+# The TIFF field types we write, and their struct formats
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_LONG8 = 16
+TIFF_FORMATS = {TIFF_SHORT: "H", TIFF_LONG: "I", TIFF_LONG8: "Q"}
+
+
+def write_page(planes: np.ndarray, path: str, level: int = PNG_LEVEL):
+    """
+    Save a page in the format of the extension of 'path': .ppm and .tif are
+    not compressed, .npy has the coverage planes (see write_planes), and
+    anything else is a PNG image, compressed at zlib 'level'.
+
+    PPM and TIFF images, and PNG images of pages on disk, are streamed, a
+    few rows at a time, so the whole image never needs to be in memory.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        write_planes(planes, path)
+    elif extension == ".ppm":
+        write_ppm(planes, path)
+    elif extension in (".tif", ".tiff"):
+        write_tiff(planes, path)
+    elif isinstance(planes.base, mmap.mmap):
+        write_png_stream(planes, path, level)
+    else:
+        Image.fromarray(composite(planes)).save(path, format="PNG",
+                                                compress_level=level)
+
+
+def _composite_strips(planes: np.ndarray) -> Iterator[np.ndarray]:
+    """
+    Composite a page PNG_STRIP_ROWS rows at a time, yielding the RGB rows
+    of each strip.
+
+    The rows of a page on disk are let go of once done.
+    """
+    pagelen, pagewidth = planes.shape[1:]
+    mapped = planes.base if isinstance(planes.base, mmap.mmap) else None
+    released = 0
+
+    for top in range(0, pagelen, PNG_STRIP_ROWS):
+        yield composite(planes[:, top:top+PNG_STRIP_ROWS])
+
+        if mapped is not None and hasattr(mmap, "MADV_DONTNEED"):
+            # The page is shared with its file, so what we drop is read
+            # back from it if we need it again
+            done = min(top + PNG_STRIP_ROWS, pagelen) * pagewidth
+            for plane in range(len(PLANES)):
+                start = plane*pagelen*pagewidth + released
+                start -= start % mmap.PAGESIZE
+                end = plane*pagelen*pagewidth + done
+                mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+            released = done
+
+
+def _png_chunk(out, kind: bytes, data: bytes):
+    out.write(struct.pack(">I", len(data)))
+    out.write(kind)
+    out.write(data)
+    out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def write_png_stream(planes: np.ndarray, path: str, level: int = 6):
+    """
+    Save a page as a PNG image, compositing and compressing it
+    PNG_STRIP_ROWS rows at a time.
+    """
+    pagelen, pagewidth = planes.shape[1:]
+    compressor = zlib.compressobj(level)
+
+    with open(path, "wb") as out:
+        out.write(b"\x89PNG\r\n\x1a\n")
+        _png_chunk(out, b"IHDR", struct.pack(">IIBBBBB", pagewidth, pagelen,
+                                             8, 2, 0, 0, 0))
+
+        for rows in _composite_strips(planes):
+            # Each row starts with its filter type. The dots are mostly
+            # isolated, and compress best without a filter.
+            filtered = np.zeros((rows.shape[0], 1 + pagewidth*3), dtype=np.uint8)
+            filtered[:, 1:] = rows.reshape(rows.shape[0], -1)
+
+            data = compressor.compress(filtered)
+            if data:
+                _png_chunk(out, b"IDAT", data)
+
+        _png_chunk(out, b"IDAT", compressor.flush())
+        _png_chunk(out, b"IEND", b"")
+
+
+def write_ppm(planes: np.ndarray, path: str):
+    """
+    Save a page as a binary PPM image, which is not compressed at all
+    """
+    with open(path, "wb") as out:
+        out.write(b"P6\n%d %d\n255\n" % (planes.shape[2], planes.shape[1]))
+        for rows in _composite_strips(planes):
+            out.write(rows.data)
+
+
+def write_tiff(planes: np.ndarray, path: str):
+    """
+    Save a page as an uncompressed TIFF image, one strip of PNG_STRIP_ROWS
+    rows at a time.
+
+    The strips go right after the header, and the directory of tags after
+    them, once we know where everything is. Images bigger than TIFF_LIMIT
+    are saved as BigTIFF.
+    """
+    pagelen, pagewidth = planes.shape[1:]
+    rowsize = pagewidth*3
+    datasize = pagelen*rowsize
+    tops = range(0, pagelen, PNG_STRIP_ROWS)
+
+    big = datasize > TIFF_LIMIT
+    header = 16 if big else 8
+    offset = "<Q" if big else "<I"
+    fieldsize = struct.calcsize(offset)
+    offsettype = TIFF_LONG8 if big else TIFF_LONG
+
+    tags = [
+        (256, TIFF_LONG, [pagewidth]),
+        (257, TIFF_LONG, [pagelen]),
+        (258, TIFF_SHORT, [8, 8, 8]),
+        # Not compressed, RGB
+        (259, TIFF_SHORT, [1]),
+        (262, TIFF_SHORT, [2]),
+        (273, offsettype, [header + top*rowsize for top in tops]),
+        (277, TIFF_SHORT, [3]),
+        (278, TIFF_LONG, [PNG_STRIP_ROWS]),
+        (279, offsettype, [min(PNG_STRIP_ROWS, pagelen - top)*rowsize for top in tops]),
+        # The R, G and B of each pixel together
+        (284, TIFF_SHORT, [1]),
+    ]
+
+    # The directory starts on a word boundary, and the values that do not
+    # fit in its entries come after it
+    directory = header + datasize + datasize % 2
+    count = "<Q" if big else "<H"
+    entry = "<HHQ8s" if big else "<HHI4s"
+    extra = (directory + struct.calcsize(count) + struct.calcsize(entry)*len(tags) +
+             fieldsize)
+
+    table = bytearray(struct.pack(count, len(tags)))
+    values = bytearray()
+    for tag, kind, tagvalues in tags:
+        data = struct.pack("<{}{}".format(len(tagvalues), TIFF_FORMATS[kind]), *tagvalues)
+        if len(data) > fieldsize:
+            values += bytes(len(values) % 2)
+            field = struct.pack(offset, extra + len(values))
+            values += data
+        else:
+            field = data
+
+        table += struct.pack(entry, tag, kind, len(tagvalues), field)
+
+    # No next directory
+    table += bytes(fieldsize)
+
+    with open(path, "wb") as out:
+        if big:
+            out.write(b"II+\0" + struct.pack("<HHQ", 8, 0, directory))
+        else:
+            out.write(b"II*\0" + struct.pack("<I", directory))
+
+        for rows in _composite_strips(planes):
+            out.write(rows.data)
+
+        out.write(bytes(datasize % 2))
+        out.write(table)
+        out.write(values)
+
+
+def write_planes(planes: np.ndarray, path: str):
+    """
+    Save the C, M, Y and K coverage planes of a page, as a (4, height, width)
+    numpy array
+    """
+    np.save(path, planes)
+
+
+class PageWriter:
+    """
+    Writes pages on 'threads' background threads, so the next page is
+    rendered while the last ones are compressed and written.
+
+    At most 'pending' pages (by default, one more than the threads) wait to
+    be written; 'write' waits for one of them before taking another, so
+    the pages do not pile up in memory. With no threads, the pages are
+    written right away.
+
+    An error writing a page is raised by the next 'write', or by 'close'.
+    """
+
+    def __init__(self, threads: int = 1, level: Optional[int] = None,
+                 pending: Optional[int] = None):
+        self.level = PNG_LEVEL if level is None else level
+        self.executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(pending or threads + 1)
+        self.futures = []
+
+    def write(self, planes: np.ndarray, path: str, done=None):
+        """
+        Write a page to 'path' (see write_page), calling 'done' with the
+        path and how long writing took, once it is written.
+
+        The page must not change until then.
+        """
+        if self.executor is None:
+            self._write(planes, path, done)
+            return
+
+        self.slots.acquire()
+        future = self.executor.submit(self._write, planes, path, done)
+        future.add_done_callback(lambda future: self.slots.release())
+
+        self._check()
+        self.futures.append(future)
+
+    def _write(self, planes: np.ndarray, path: str, done):
+        start = time.perf_counter()
+        write_page(planes, path, self.level)
+        if done is not None:
+            done(path, time.perf_counter() - start)
+
+    def _check(self, wait: bool = False):
+        pending = []
+        for future in self.futures:
+            if wait or future.done():
+                future.result()
+            else:
+                pending.append(future)
+
+        self.futures = pending
+
+    def close(self):
+        """
+        Wait for every page to be written
+        """
+        if self.executor is None:
+            return
+
+        try:
+            self._check(wait=True)
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
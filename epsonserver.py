@@ -1,65 +1,152 @@
-import socket
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
 import sys
+import tempfile
+import time
 
-from dataclasses import dataclass
-from typing import Optional
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterator, Optional
+
+# numpy is only loaded when we draw (see PageRenderer.run), but the pages
+# are annotated with it
+if TYPE_CHECKING:
+    import numpy as np
 
 @dataclass
 class PrintJob:
     name: str
 
 
-def decode_packbits(buf: bytes) -> bytes:
+class PackBitsDecoder:
     """
-    Decode a PackBits compressed buffer.
+    Incremental PackBits decoder
+
+    It decodes the data it is fed straight into a preallocated buffer of
+    'size' bytes, and stops as soon as that buffer is full.
 
-    Returns an uncompressed buffer.
+    If 'keep' is False, there is no buffer: 'skip' goes through the runs
+    without decoding them, to know where the data ends.
     """
-    rbuf = b""
-    i = -1
-    while i < len(buf)-1:
-        i += 1
 
-        byteval = ord(buf[i:i+1])
-        if byteval >= 0 and byteval <= 127:
-            # next byteval+1 bytes needs to be copied
-            rbuf += buf[i+1:i+2+byteval]
-            i += byteval+1
-        else:
-            byteval = 256 - byteval
-            if byteval == 128:
-                continue # 128 means skip this byte
+    def __init__(self, size: int, keep: bool = True):
+        self.size = size
+        self.buf = bytearray(size) if keep else None
+        self.written = 0
+        self.error = None
+
+        # How many bytes of compressed data we went through
+        self.read = 0
+
+    @property
+    def done(self) -> bool:
+        return self.written >= self.size
+
+    @property
+    def data(self) -> memoryview:
+        """
+        The data decoded until now
+        """
+        return memoryview(self.buf)[:self.written]
+
+    def feed(self, buf: bytes) -> int:
+        """
+        Decode the complete runs at the start of 'buf'.
+
+        Returns how many bytes of 'buf' were used. A run cut at the end of
+        'buf' is not used, so it has to be fed again, with the rest of it.
+
+        A run that does not fit in the buffer is cut, and 'error' is set.
+        """
+        out = self.buf
+        size = len(out)
+        written = self.written
+        buflen = len(buf)
+        i = 0
+
+        while written < size and i < buflen:
+            byteval = buf[i]
+            if byteval < 128:
+                # next byteval+1 bytes needs to be copied
+                count = byteval+1
+                if i+1+count > buflen:
+                    break
+
+                run = buf[i+1:i+1+count]
+                i += 1+count
+            elif byteval == 128:
+                i += 1 # 128 means skip this byte
+                continue
             else:
-                # repeat the next byte of data 1+byteval types
+                # repeat the next byte of data 257-byteval times
+                count = 257-byteval
+                if i+2 > buflen:
+                    break
+
+                run = bytes((buf[i+1],)) * count
+                i += 2
+
+            if written+count > size:
+                self.error = "run of {} bytes overflows the band by {} bytes".format(
+                    count, written+count-size)
+                count = size-written
+                run = run[:count]
+
+            out[written:written+count] = run
+            written += count
+
+        self.written = written
+        self.read += i
+        return i
+
+    def skip(self, buf: bytes) -> int:
+        """
+        Like 'feed', but only count the bytes the runs decode to.
+        """
+        size = self.size
+        written = self.written
+        buflen = len(buf)
+        i = 0
+
+        while written < size and i < buflen:
+            byteval = buf[i]
+            if byteval < 128:
+                count = byteval+1
+                step = count+1
+            elif byteval == 128:
                 i += 1
-                rbuf += buf[i:i+1] * (byteval+1)
-
-#        print(repr(rbuf))
-
-    return rbuf
-
-
-print(repr(decode_packbits(b"\xfe\xaa\x02\x80\x00\x2a\xfd\xaa\x03\x80\x00\x2a\x22\xf7\xaa")))
-#with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-#    s.bind(("127.0.0.1", 9100))
-#    s.listen()
-#    print("listening to 0.0.0.0:9100")
-#
-#    conn, addr = s.accept()
-#    with conn:
-#        print("job accepted!")
-#        count = 1
-#
-#        with open("out.epson", "wb") as out:
-#            while count > 0:
-#                msg = conn.recv(10240)
-#
-#                print("Receiving message")
-#
-#                count = len(msg)
-#                out.write(msg)
-#
-#            print("Received everything.")
+                continue
+            else:
+                count = 257-byteval
+                step = 2
+
+            if i+step > buflen:
+                break
+
+            i += step
+            written += count
+
+        if written > size:
+            self.error = "run of {} bytes overflows the band by {} bytes".format(
+                count, written-size)
+            written = size
+
+        self.written = written
+        self.read += i
+        return i
+
 
 class Printing:
     """
@@ -68,46 +155,118 @@ class Printing:
     pass
 
 
-def parse_until_enable_printing(stream):
+# The command that enables printing, at the start of each job
+PREAMBLE = b"\x1b\x01@EJL 1284.4\n@EJL\x20\x20\x20\x20\x20\n\x1b@"
+
+# The JE remote command, that ends a job
+JOB_END = b"JE\x01\x00\x00"
+
+# How much we read at a time, looking for the preamble
+PREAMBLE_CHUNK = 1 << 20
+
+
+def parse_until_enable_printing(stream) -> bytes:
     """
     To enable printing on Epson printers, the driver must send this command:
 
     > ESC 01@EJL[space]1284.4[newline]@EJL[space][space][space][space]
 [space][newline]ESC@
 
-    This command receives a byte stream (file or socket) and receives data
-    from it until it finds this pattern.
+    This command receives a byte stream (file, socket or mapped file) and
+    receives data from it until it finds this pattern.
 
-    We return the stream, left right after this message.
-    If EOF is reached, it will return an exception.
+    The stream is left right after this message. If it can not be seeked
+    back to there, we return the data read past it (or else nothing).
+    If EOF is reached before it, we raise EOFError.
     """
-    lines = [
-        b"\x1b\x01@EJL 1284.4\n",
-        b"@EJL\x20\x20\x20\x20\x20\n",
-        b"\x1b@"
-    ]
+    if isinstance(stream, mmap.mmap):
+        found = stream.find(PREAMBLE, stream.tell())
+        if found < 0:
+            raise EOFError("no printing preamble before the end of the data")
 
-    messageidx = 0
+        stream.seek(found + len(PREAMBLE))
+        trace(TRACE_BYTES, "preamble at pos {}", found)
+        return b""
 
-    while messageidx <= 2:
-        print("l {} pos {}".format(messageidx, stream.tell()))
-        if messageidx < 2:
-            line = stream.readline()
-        else:
-            line = stream.read(2) # the last line does not end with a readline()
+    buf = bytearray()
+    read = 0
+    while True:
+        chunk = stream.read(PREAMBLE_CHUNK)
+        if not chunk:
+            raise EOFError("no printing preamble before the end of the data")
+
+        buf += chunk
+        read += len(chunk)
+        found = buf.find(PREAMBLE)
+        if found >= 0:
+            break
 
-        compline = lines[messageidx]
-        if messageidx == 0:
-            cond = line.endswith(compline)
-        else:
-            cond = line == compline
+        # The preamble can be cut between two chunks
+        del buf[:len(buf) - len(PREAMBLE) + 1]
+
+    rest = bytes(buf[found + len(PREAMBLE):])
+    trace(TRACE_BYTES, "preamble at pos {}", read - len(buf) + found)
+
+    if rest and stream.seekable():
+        stream.seek(-len(rest), io.SEEK_CUR)
+        return b""
+
+    return rest
+
+
+def find_preamble(buf) -> int:
+    """
+    Return where the printing preamble ends on 'buf' (bytes, a mapped file
+    or any buffer), without copying it. If it is not there, we raise
+    EOFError.
+    """
+    if hasattr(buf, "find"):
+        found = buf.find(PREAMBLE)
+    else:
+        # Other buffers are searched a chunk at a time
+        view = memoryview(buf).cast("B")
+        found = -1
+        for start in range(0, len(view), PREAMBLE_CHUNK):
+            chunk = bytes(view[start:start + PREAMBLE_CHUNK + len(PREAMBLE) - 1])
+            found = chunk.find(PREAMBLE)
+            if found >= 0:
+                found += start
+                break
+
+    if found < 0:
+        raise EOFError("no printing preamble before the end of the data")
+
+    trace(TRACE_BYTES, "preamble at pos {}", found)
+    return found + len(PREAMBLE)
+
+
+def split_jobs(buf) -> list[tuple[int, int]]:
+    """
+    Find the print jobs on a capture of many of them, back to back ('buf'
+    is bytes or a mapped file), and return where each one starts and how
+    long it is.
+
+    A job starts at its printing preamble, and ends right after its last JE
+    remote command before the next preamble (or at the next preamble, if
+    it was cut short).
+    """
+    starts = []
+    found = buf.find(PREAMBLE)
+    while found >= 0:
+        starts.append(found)
+        found = buf.find(PREAMBLE, found + len(PREAMBLE))
 
-        if cond is True:
-            print("l {} pos {}".format(messageidx, stream.tell()))
-            messageidx += 1
+    jobs = []
+    for start, end in zip(starts, starts[1:] + [len(buf)]):
+        jobend = buf.rfind(JOB_END, start, end)
+        if jobend >= 0:
+            end = jobend + len(JOB_END)
+            if buf[end:end + len(CommandLexer.REMOTE_END)] == CommandLexer.REMOTE_END:
+                end += len(CommandLexer.REMOTE_END)
 
+        jobs.append((start, end - start))
 
-    return stream
+    return jobs
 
 
 remote_mode = False
@@ -118,596 +277,2710 @@ class Command:
     ctype: str
     parameters: bytes
 
-    @staticmethod
-    def parse_remote(buf: bytes) -> Optional:
-        """
-        Parse a remote command.
+    # Where the command starts in the stream
+    offset: int = -1
 
-        Remote commands control extra attributes, like print size, etc.
+    # The data that comes after the command (the dots of an ESC i band),
+    # already uncompressed.
+    payload: Optional[memoryview] = field(default=None, repr=False)
 
-        Returns a command if the command seems valid (it has the right size),
-        and None if it is not
+    # How many bytes of the stream that data took, compressed or not
+    received: int = field(default=0, repr=False)
 
-        A remote command always has two bytes of type, two bytes of count and
-        the remaining data are parameters.
+
+# How much we tell about what the printer is doing
+TRACE_OFF = 0
+# Only the jobs and pages, and what went wrong with them
+TRACE_SUMMARY = 1
+# What each command does
+TRACE_COMMANDS = 2
+# Also the map of the bands on stderr, and the search for the printing
+# preamble
+TRACE_BYTES = 3
+
+TRACE_LEVELS = {
+    'off': TRACE_OFF,
+    'summary': TRACE_SUMMARY,
+    'commands': TRACE_COMMANDS,
+    'bytes': TRACE_BYTES,
+}
+
+trace_level = TRACE_SUMMARY
+
+# A file receiving each evaluated command as a JSON line, if any
+trace_sink = None
+
+
+def set_trace(level: int, sink=None):
+    """
+    Trace everything up to 'level', and write the commands to 'sink'
+    """
+    global trace_level, trace_sink
+    trace_level = level
+    trace_sink = sink
+
+
+def trace(level: int, message: str, *args, **kwargs):
+    """
+    Print 'message', formatted with 'args', if we trace 'level'.
+
+    The formatting is done here, so the levels we do not trace cost only
+    a call.
+    """
+    if level <= trace_level:
+        print(message.format(*args) if args else message, **kwargs)
+
+
+def trace_command(cmd: Command):
+    trace_sink.write(json.dumps(dict(
+        offset=cmd.offset, command=cmd.name, params=cmd.parameters.hex()
+    )))
+    trace_sink.write("\n")
+
+
+class Profiler:
+    """
+    Where the time of a render goes.
+
+    For each command name: how many there were, how many bytes of the
+    stream they took, and how long each took to parse (with the band
+    decoding) and to evaluate. For each band: how long it took to decode and
+    to rasterize. For each page: how long it took, in all.
+
+    PageRenderer only goes through the profiler (see 'set_profiler') when
+    there is one, so rendering without it costs nothing more.
+    """
+
+    def __init__(self):
+        # By command name: count, bytes, parse time, evaluation time, and
+        # the time of each command
+        self.commands = {}
+
+        # Decode and raster time, and unpacked size, of each band. The
+        # bands rasterized in parallel have no raster time of their own.
+        self.banddecode = array("d")
+        self.bandraster = array("d")
+        self.bandsize = array("Q")
+
+        # Time and band count of each page, the time finishing it took (the
+        # parallel rasterization, if any), and writing it, if it was written
+        self.pagetime = array("d")
+        self.pagebands = array("Q")
+        self.pagefinish = array("d")
+        self.pagewrite = array("d")
+
+        self.pagestart = None
+        self.bands = 0
+        self.parsed = 0.0
+
+    def lex(self, lexer: CommandLexer) -> Iterator[Command]:
         """
-        if len(buf) < 4:
-            return None
+        Go through the commands of 'lexer', timing how long each takes to
+        parse
+        """
+        commands = iter(lexer)
+        while True:
+            start = time.perf_counter()
+            if self.pagestart is None:
+                self.pagestart = start
+
+            cmd = next(commands, None)
+            if cmd is None:
+                return
 
-        if buf == b'\x1b\x00\x00\x00':
-            """
-            The remote command mode ends if we read bytes '\x1b \x00 \x00 \x00'.
-            """
-            return Command('remote-end', 'remote', b'')
+            self.parsed = time.perf_counter() - start
+            yield cmd
 
+    def eval_command(self, cmd: Command, state: PrinterState) -> PrinterState:
+        start = time.perf_counter()
+        state = eval_command(cmd, state)
+        elapsed = time.perf_counter() - start
 
-        name = buf[0:2].decode('ascii')
-        bytecount = buf[2] + buf[3]*256
-        params = buf[4:]
+        stats = self.commands.get(cmd.name)
+        if stats is None:
+            stats = self.commands[cmd.name] = [0, 0, 0.0, 0.0, array("d")]
 
-        if len(params) != bytecount:
+        stats[0] += 1
+        stats[1] += len(cmd.parameters) + cmd.received
+        stats[2] += self.parsed
+        stats[3] += elapsed
+        stats[4].append(self.parsed + elapsed)
+
+        return state
+
+    def band(self, band, plot=None, *args, **kwargs):
+        """
+        Count a band, and plot it with 'plot', if any
+        """
+        self.bands += 1
+        self.banddecode.append(self.parsed)
+        self.bandsize.append(len(band.data))
+        if plot is None:
+            self.bandraster.append(0.0)
             return None
 
-        return Command(name, 'remote', params)
+        start = time.perf_counter()
+        planes = plot(*args, band, **kwargs)
+        self.bandraster.append(time.perf_counter() - start)
+        return planes
+
+    def page(self, finish: float):
+        """
+        Count a page that is finished, 'finish' seconds after its last
+        command
+        """
+        if self.pagestart is not None:
+            self.pagetime.append(time.perf_counter() - self.pagestart)
+        else:
+            self.pagetime.append(finish)
+        self.pagebands.append(self.bands)
+        self.pagefinish.append(finish)
+
+        self.pagestart = None
+        self.bands = 0
+
+    @staticmethod
+    def percentiles(times) -> dict:
+        ordered = sorted(times)
+        return {"p{}".format(p): ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+                for p in (50, 90, 99)}
 
     @staticmethod
-    def parse_normal(buf: bytes) -> Optional:
+    def histogram(times) -> dict:
+        """
+        How many of 'times' fall on each power of two of microseconds
+        """
+        buckets = Counter(max(0, int(t * 1e6)).bit_length() for t in times)
+        return {"<{}us".format(1 << bucket): count for bucket, count in sorted(buckets.items())}
+
+    def to_dict(self) -> dict:
+        commands = {}
+        for name, (count, size, parsed, evaluated, times) in self.commands.items():
+            commands[name] = dict(count=count, bytes=size, parse=parsed,
+                                  eval=evaluated, **self.percentiles(times),
+                                  histogram=self.histogram(times))
+
+        return dict(
+            commands=commands,
+            bands=dict(decode=list(self.banddecode), raster=list(self.bandraster),
+                       bytes=list(self.bandsize)),
+            pages=dict(time=list(self.pagetime), bands=list(self.pagebands),
+                       finish=list(self.pagefinish), write=list(self.pagewrite)),
+        )
+
+    def write_json(self, out):
+        json.dump(self.to_dict(), out, indent=1)
+
+    def write_folded(self, out):
+        """
+        Write the times as folded stacks (render;parse;NAME MICROSECONDS),
+        for flamegraph.pl, speedscope and the like
+        """
+        for name, (_, _, parsed, evaluated, _) in sorted(self.commands.items()):
+            label = repr(name)[1:-1].replace(";", ":").replace(" ", "_")
+            out.write("render;parse;{} {}\n".format(label, round(parsed * 1e6)))
+            out.write("render;eval;{} {}\n".format(label, round(evaluated * 1e6)))
+
+        out.write("render;raster;bands {}\n".format(round(sum(self.bandraster) * 1e6)))
+        out.write("render;raster;finish {}\n".format(round(sum(self.pagefinish) * 1e6)))
+        out.write("render;write {}\n".format(round(sum(self.pagewrite) * 1e6)))
+
+    def report(self, out=sys.stderr):
+        """
+        Print where the time went
+        """
+        total = sum(stats[2] + stats[3] for stats in self.commands.values())
+        total += sum(self.bandraster) + sum(self.pagefinish) + sum(self.pagewrite)
+
+        print("{:<12} {:>8} {:>12} {:>10} {:>10} {:>10} {:>10} {:>6}".format(
+            "command", "count", "bytes", "parse ms", "eval ms", "p50 us", "p99 us", "%"),
+            file=out)
+        for name, (count, size, parsed, evaluated, times) in sorted(
+                self.commands.items(), key=lambda item: -(item[1][2] + item[1][3])):
+            percentiles = self.percentiles(times)
+            print("{:<12} {:>8} {:>12} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>6.1f}".format(
+                repr(name), count, size, parsed * 1e3, evaluated * 1e3,
+                percentiles["p50"] * 1e6, percentiles["p99"] * 1e6,
+                100 * (parsed + evaluated) / total if total > 0 else 0), file=out)
+
+        if len(self.bandsize) > 0:
+            print("bands: {}, {:.2f} ms decoding, {:.2f} ms rasterizing ({:.1f} MB)".format(
+                len(self.bandsize), sum(self.banddecode) * 1e3,
+                sum(self.bandraster) * 1e3, sum(self.bandsize) / 1e6), file=out)
+
+        for pageno, elapsed in enumerate(self.pagetime, start=1):
+            written = ""
+            if pageno <= len(self.pagewrite):
+                written = ", {:.3f} s writing".format(self.pagewrite[pageno - 1])
+
+            print("page {}: {:.3f} s, {} bands, {:.3f} s finishing{}".format(
+                pageno, elapsed, self.pagebands[pageno - 1], self.pagefinish[pageno - 1],
+                written), file=out)
+
+
+# The profiler of the renders, if any
+profiler = None
+
+
+def set_profiler(new: Optional[Profiler]):
+    """
+    Profile the renders with 'new' (or stop profiling, with None)
+    """
+    global profiler
+    profiler = new
+
+
+# Parameter sizes of the commands that do not say their size
+COMMAND_SIZES = {
+    'U': 1,
+    '@': 0,
+    '\\': 2,
+    'r': 1,
+    '\r': 0,
+    '\x0c': 0,
+    'i': 7,
+}
+
+ESC = 0x1b
+
+# How much of a mapped dump we go through before letting the kernel drop the
+# pages we have already parsed
+DUMP_WINDOW = 16 << 20
+
+
+class CommandLexer:
+    """
+    Split a printer byte stream into commands.
+
+    Iterating over it yields each command in 'buf', starting at 'pos'.
+    'offset' is the position of 'buf' in the whole stream, so we can say
+    where things are.
+
+    If 'final' is False, more data can be added with 'feed' (and the end of
+    the data marked with 'close'). Iterating then stops at the first
+    incomplete command, and goes on from it after the next 'feed'.
+
+    If 'decode' is False, the bands are skipped instead of being decoded,
+    and their commands come without a payload. It can also be a function,
+    called with each ESC i command before its band is read, saying if that
+    band is decoded.
+    """
+
+    # The 1284.4 mode command, sent with an ESC before it, acts as a reset
+    RESTART = b"\x01@EJL 1284.4\n@EJL\x20\x20\x20\x20\x20\n"
+
+    REMOTE_END = b"\x1b\x00\x00\x00"
+
+    def __init__(self, buf: bytes = b"", pos: int = 0, offset: int = 0,
+                 final: bool = True, decode=True):
+        self.final = final
+        self.decode = decode
+
+        # We keep a copy of fed data, so we can append to it and drop what
+        # we already parsed.
+        self.data = None if final else bytearray(buf)
+
+        self.buf = memoryview(buf if final else self.data)
+        self.pos = pos
+        self.offset = offset
+
+        # A mapped dump is read once, front to back, and we let the kernel
+        # drop the pages we are done with
+        self.mapped = buf if isinstance(buf, mmap.mmap) else None
+        self.released = 0
+        if self.mapped is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        # Remote commands have a different syntax, so we need to know when we
+        # are on remote mode.
+        self.remote = False
+
+        # A band still waiting for its data, and its decoder
+        self.band = None
+        self.decoder = None
+
+    def tell(self) -> int:
+        """
+        Return the stream position of the next command
+        """
+        return self.offset + self.pos
+
+    def feed(self, data: bytes):
         """
-        Tries to parse a normal command.
+        Add data to the end of the stream
+        """
+        if self.data is None:
+            raise RuntimeError("This lexer does not take more data")
+
+        self.buf.release()
+        del self.data[:self.pos]
+        self.offset += self.pos
+        self.pos = 0
 
-        Returns a command if the command seems valid (it has the right size),
-        and None if it is not
+        self.data += data
+        self.buf = memoryview(self.data)
+
+    def close(self):
+        """
+        Mark the end of the stream
         """
+        self.final = True
 
-        sizelist = {
-            'U': 1,
-            '@': 0,
-            '\\': 1,
-            'r': 1,
-            '\r': 0,
-            'i': 7,
-        }
+    def __iter__(self):
+        while True:
+            cmd = self.next_command()
+            if cmd is None:
+                return
 
-        restart = b"\x01@EJL 1284.4\n@EJL\x20\x20\x20\x20\x20\n"
-        if buf.endswith(restart):
-            print("1284.4 mode command recognized, acting as it was a reset")
-            name = "@"
-            params = []
-            bytecount = 0
+            yield cmd
 
-        elif buf[0] == ord('('):
-            if len(buf) < 4:
+    def next_command(self) -> Optional[Command]:
+        """
+        Parse the command at the current position, and move past it.
+
+        Returns None at the end of the data (or, if more data can come, at
+        an incomplete command).
+        """
+        if self.band is not None:
+            cmd = self.band
+            if not self._read_band(cmd):
                 return None
 
-            name = buf[0:2].decode('ascii')
-            bytecount = buf[2] + buf[3]*256
-            params = buf[4:]
+            self.band = None
+            return cmd
+
+        buf = self.buf
+        pos = start = self.pos
+        if self.remote:
+            cmd, end = self._parse_remote(buf, pos)
         else:
-            if len(buf) < 1:
-                return None
+            # The ESC before normal commands is optional for us
+            while pos < len(buf) and buf[pos] == ESC:
+                pos += 1
+
+            cmd, end = self._parse_normal(buf, pos)
 
-            name = buf[0:1].decode('ascii')
-            bytecount = sizelist.get(name, 99)
-            params = buf[1:1+bytecount]
+        if cmd is None:
+            if not self.final:
+                return None
 
+            if pos < len(buf):
+                trace(TRACE_SUMMARY, "Incomplete command at the end of the data (at pos {0} ({0:02x}))",
+                    self.offset + pos, file=sys.stderr)
 
-        if len(params) != bytecount:
+            self.pos = len(buf)
             return None
 
-        return Command(name, 'normal', params)
+        cmd.offset = self.offset + start
+        self.pos = end
+        if self.mapped is not None and end - self.released >= DUMP_WINDOW:
+            self._release()
+
+        if cmd.name == 'i':
+            if not self._read_band(cmd):
+                self.band = cmd
+                return None
+        elif cmd.name == "(R" and cmd.parameters == b'\x00REMOTE1':
+            self.remote = True
+        elif cmd.name == 'remote-end':
+            self.remote = False
+
+        return cmd
+
+    def _release(self):
+        """
+        Drop the pages of the mapped dump before the current position
+        """
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+
+        upto = self.pos - self.pos % mmap.PAGESIZE
+        self.mapped.madvise(mmap.MADV_DONTNEED, self.released, upto - self.released)
+        self.released = upto
+
+    def _parse_remote(self, buf, pos):
+        """
+        A remote command always has two bytes of type, two bytes of count and
+        the remaining data are parameters.
+
+        The remote command mode ends if we read bytes '\x1b \x00 \x00 \x00'.
+        """
+        if pos+4 > len(buf):
+            return None, pos
+
+        if buf[pos:pos+4] == self.REMOTE_END:
+            return Command('remote-end', 'remote', b''), pos+4
+
+        name = bytes(buf[pos:pos+2]).decode('latin-1')
+        end = pos + 4 + buf[pos+2] + buf[pos+3]*256
+        if end > len(buf):
+            return None, pos
+
+        return Command(name, 'remote', bytes(buf[pos+4:end])), end
+
+    def _parse_normal(self, buf, pos):
+        if pos >= len(buf):
+            return None, pos
+
+        if buf[pos] == self.RESTART[0]:
+            size = min(len(self.RESTART), len(buf)-pos)
+            if buf[pos:pos+size] == self.RESTART[:size]:
+                if size < len(self.RESTART) and not self.final:
+                    return None, pos
+
+                if size == len(self.RESTART):
+                    trace(TRACE_COMMANDS, "1284.4 mode command recognized, acting as it was a reset")
+                    return Command("@", 'normal', b''), pos+size
+
+        if buf[pos] == ord('('):
+            if pos+4 > len(buf):
+                return None, pos
+
+            name = bytes(buf[pos:pos+2]).decode('latin-1')
+            start = pos+4
+            end = start + buf[pos+2] + buf[pos+3]*256
+        else:
+            name = chr(buf[pos])
+            start = pos+1
+            end = start + COMMAND_SIZES.get(name, 0)
+
+        if end > len(buf):
+            return None, pos
+
+        return Command(name, 'normal', bytes(buf[start:end])), end
+
+    def _read_band(self, cmd: Command) -> bool:
+        """
+        Read the dots that come after an ESC i command.
+
+        Returns False if they did not arrive yet.
+        """
+        params = cmd.parameters
+        compress = params[1]
+        toread = (params[3] + (params[4] << 8)) * (params[5] + (params[6] << 8))
+
+        decode = self.decode
+        if callable(decode):
+            decode = decode(cmd)
+
+        if compress == 1:
+            if self.decoder is None:
+                self.decoder = PackBitsDecoder(toread, decode)
+
+            decoder = self.decoder
+            decode = decoder.buf is not None
+            if decode:
+                self.pos += decoder.feed(self.buf[self.pos:])
+            else:
+                self.pos += decoder.skip(self.buf[self.pos:])
+            if decoder.error is None and not decoder.done:
+                if not self.final:
+                    return False
+
+                decoder.error = "data ended after {} of {} bytes".format(
+                    decoder.written, toread)
+                self.pos = len(self.buf)
+
+            if decoder.error is not None:
+                trace(TRACE_SUMMARY, "\tBad packbits data: {}", decoder.error, file=sys.stderr)
+
+            self.decoder = None
+            cmd.received = decoder.read
+            if decode:
+                cmd.payload = decoder.data
+        else:
+            if len(self.buf) - self.pos < toread and not self.final:
+                return False
+
+            end = min(self.pos+toread, len(self.buf))
+            if decode:
+                cmd.payload = self.buf[self.pos:end]
+
+                # Fed data is dropped once parsed, so the band needs its own
+                # copy
+                if self.data is not None:
+                    cmd.payload = memoryview(bytes(cmd.payload))
+
+            cmd.received = end - self.pos
+            self.pos = end
+
+            if cmd.received < toread:
+                trace(TRACE_SUMMARY, "\tBand data ended after {} of {} bytes",
+                      cmd.received, toread, file=sys.stderr)
+
+        return True
+
+
+# Where the printer head starts on each page, in pageunits
+INITIAL_HEADTOP = -80
+
+
+@dataclass(slots=True)
+class PrinterState:
+    """
+    What the printer knows at some point of a job
+    """
+    remote: bool = False
+    printing: bool = False
+    graphics: bool = False
+    page_end: bool = False
+
+    # The units, in inches
+    pageunits: float = 0
+    vunits: float = 0
+    hunits: float = 0
+
+    # The page size, expressed in PAGEUNITS
+    pagelen: int = 0
+    pagewidth: int = 0
+
+    # The printer head current location
+    headtop: int = INITIAL_HEADTOP
+    headleft: int = 0
+
+    previous_color: Optional[int] = None
+
+    # How much the head will walk after each draw operation
+    headstep: int = 0
+
+    # If the job asked to print only one way (the U command)
+    unidirectional: bool = False
+
+    # The band that the last command started printing
+    printinfo: dict = field(default_factory=dict)
 
-def eval_command(cmd: Command, state):
+
+# The functions that evaluate each command, by command name
+COMMAND_HANDLERS = {}
+REMOTE_HANDLERS = {}
+
+
+def command_handler(name: str, handlers: dict = COMMAND_HANDLERS):
+    """
+    Register the decorated function as the one evaluating the command 'name'.
+    """
+    def register(func):
+        handlers[name] = func
+        return func
+
+    return register
+
+
+def remote_handler(name: str):
+    return command_handler(name, REMOTE_HANDLERS)
+
+
+def unknown_command(cmd: Command, state: PrinterState):
+    if cmd.ctype == 'remote':
+        trace(TRACE_COMMANDS, "unknown remote command evaluated: {!r}", cmd)
+    else:
+        trace(TRACE_COMMANDS, "unknown command evaluated: {!r}", cmd)
+
+
+def eval_command(cmd: Command, state: PrinterState) -> PrinterState:
     """
     Evaluate a printer command
 
     Return the new printer state after that command.
     """
-    remote = state.get('remote', False)
+    if trace_sink is not None:
+        trace_command(cmd)
 
-    printing = state.get('printing', False)
-    printinfo = {}
+    state.printinfo = {}
+    state.page_end = False
 
-    graphics = state.get('graphics', False)
-    vunit = hunit = pageunits = state.get('pageunits', False)
+    handlers = REMOTE_HANDLERS if cmd.ctype == 'remote' else COMMAND_HANDLERS
+    handlers.get(cmd.name, unknown_command)(cmd, state)
 
+    return state
 
-    if cmd.name == 'remote-end':
-        print("Leaving remote mode.")
-        remote = False
 
-    elif cmd.ctype == 'remote':
-        if cmd.name == 'SN' and cmd.parameters[0] == 0 and len(cmd.parameters) == 3:
-            print("Select Mechanism Sequence: operation={:02x}, value(yy)={:02x}".format(
-                cmd.parameters[1], cmd.parameters[2]
-            ))
-        elif cmd.name == 'FP' and cmd.parameters[0] == 0:
-            value = cmd.parameters[1] + cmd.parameters[2]*256
+@remote_handler('remote-end')
+def _remote_end(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Leaving remote mode.")
+    state.remote = False
 
-            if value == 0xffb0:
-                print("Horizontal Left Margin: Borderless")
-            else:
-                print("Horizontal Left Margin: {} inches ({} units of 1/360 inches)".format(
-                    value*360.0, value
-                ))
-        elif cmd.name == 'PP' and cmd.parameters[0] == 0:
-            print("Select Paper Path: tray={:02x}, number(yy)={:02x}".format(
-                cmd.parameters[1], cmd.parameters[2]
-            ))
-        else:
-            print("unknown remote command evaluated: ", repr(cmd))
 
+@remote_handler('SN')
+def _select_mechanism(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 0 or len(cmd.parameters) != 3:
+        return unknown_command(cmd, state)
 
-    else:
-        if cmd.name == "@":
-            print("Printer reset")
-            graphics = False
-            remote = False
-            printing = False
-
-        if cmd.name == "\r":
-            print("\n\n\nPrinter carriage return (back to the start of the line)\n\n")
-            state.update(headleft=0)
-            graphics = False
-            remote = False
-            printing = False
-            print(" ", end="", file=sys.stderr)
+    trace(TRACE_COMMANDS, "Select Mechanism Sequence: operation={:02x}, value(yy)={:02x}",
+        cmd.parameters[1], cmd.parameters[2]
+    )
 
-        elif cmd.name == "(R" and cmd.parameters == b'\x00REMOTE1':
-            print("Entering remote mode.")
-            remote = True
-
-        elif cmd.name == "(G" and cmd.parameters[0] == 1:
-            print("Graphics Mode Enabled")
-            graphics = True
-
-        elif cmd.name == "(U":
-            if len(cmd.parameters) == 1:
-                value = cmd.parameters[0]
-                print("Basic Unit of Measurement (multiples of 1/3600 inch)")
-                print("aka the printer DPI")
-                print("setting value to {} ({} dpi)".format(value, 3600/value))
-                pageunit = vunit = hunit = value/3600
-            elif len(cmd.parameters) == 5:
-                pageunit = cmd.parameters[0]
-                vunit = cmd.parameters[1]
-                hunit = cmd.parameters[2]
-                baseunit = cmd.parameters[3] + cmd.parameters[4]*256
-                print("Basic Unit of Measurement (multiples of 1/BASEUNIT inch)")
-                print("aka the printer DPI")
-                print("pageunit={}, vunit={}, hunit={}, baseunit={}".format(
-                    pageunit, vunit, hunit, baseunit
-                ))
-                print("dpis: pageunit={}, vunit={}, hunit={}".format(
-                    baseunit/pageunit, baseunit/vunit, baseunit/hunit
-                ))
-                pageunits = pageunit
-
-                # We save the units in inches, not in terms of baseunits, because we
-                # want to treat all values the same, and depending on the command,
-                # the scale changes.
-
-                vunit = vunit / baseunit
-                hunit = hunit / baseunit
-                pageunit = pageunit / baseunit
-
-            print(f"\tin inches: pageunit={pageunit}, vunit={vunit}, hunit={hunit}")
-
-            state.update(
-                vunits=vunit,
-                hunits=hunit,
-                pageunits=pageunit
-            )
-
-        elif cmd.name == "U":
-            print("Print direction: {}".format(
-                "unidirectional" if cmd.parameters[0] == 1 else "bidirectional"
-            ))
-
-        elif cmd.name == "(d":
-            # We have a (d command, but omitting it caused no changes to the actual
-            # printing process.
-            print("Unknown command (d with params len {}",
-                  len(cmd.parameters))
-
-        elif cmd.name == "(i":
-            print("Interleave mode enabled (mode {})".format(
-                cmd.parameters[0]
-            ))
-
-        elif cmd.name == '(C' and len(cmd.parameters) in [2,4]:
-            print(repr(cmd))
-            params = cmd.parameters
-            if len(params) == 2:
-                length = params[0] + (params[1] << 8)
-            elif len(params) == 4:
-                length = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
-
-            print("Page length: {} pageunits".format(length))
-            print("\t this means {} inches".format(length*state["pageunits"]))
-
-        elif cmd.name == '(c' and len(cmd.parameters) in [4,8]:
-            params = cmd.parameters
-            top = 0
-            pagelength = 0
-
-            if len(params) == 2:
-                top = params[0] + (params[1] << 8)
-                pagelength = params[2] + (params[3] << 8)
-            elif len(params) == 4:
-                top = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
-                pagelength = params[4] + (params[5] << 8) + (params[6] << 16) + (params[7] << 24)
-
-            print("Vertical page margin in pageunits: top={}, pagelength={}".format(top, pagelength))
-            print("\t in inches: top={}, pagelength={}".format(top*state["pageunits"],
-                                                               pagelength*state["pageunits"]))
-
-
-        elif cmd.name == '(S' and len(cmd.parameters) == 8:
-            print(repr(cmd))
-            params = cmd.parameters
-            width = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
-            length = params[4] + (params[5] << 8) + (params[6] << 16) + (params[7] << 24)
-
-            print("Printed page size in pageunits: width={}, length={}".format(width, length))
-            print("\t in inches: width={}, length={}".format(width*state["pageunits"],
-                                                             length*state["pageunits"]))
-
-            state.update(
-                pagelen=length,
-                pagewidth=width
-            )
-
-
-
-        elif cmd.name == '(K' and cmd.parameters[0] == 0 and len(cmd.parameters) == 2:
-            print("Setting color mode: ", end='')
-            mode = cmd.parameters[1]
-            if mode == 1:
-                print("grayscale")
-            elif mode in [0,2]:
-                print(f"color ({mode})")
-            else:
-                print(f"unknown ({mode})")
 
-        elif cmd.name == '(D' and len(cmd.parameters) == 4:
-            params = cmd.parameters
-            baseunit = params[0] + (params[1] << 8) #baseunit must be 14400
-            vertical = params[2]
-            horizontal = params[3]
+@remote_handler('FP')
+def _left_margin(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 0:
+        return unknown_command(cmd, state)
 
-            print("Setting printer horizontal and vertical spacing")
-            print("baseunit={} (should be 14400), vertical={}, horizontal={}".format(
-                baseunit, vertical, horizontal
-            ))
+    value = cmd.parameters[1] + cmd.parameters[2]*256
 
-            nozzle_horizontal = horizontal / baseunit
-            nozzle_vertical = vertical * 720 / baseunit
+    if value == 0xffb0:
+        trace(TRACE_COMMANDS, "Horizontal Left Margin: Borderless")
+    else:
+        trace(TRACE_COMMANDS, "Horizontal Left Margin: {} inches ({} units of 1/360 inches)",
+            value*360.0, value
+        )
 
-            print("nozzle distance (in inches): vertical=1/{}, horizontal=1/{}".format(
-                nozzle_horizontal, nozzle_vertical
-            ))
 
-            # What exactly is this above?
+@remote_handler('PP')
+def _paper_path(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 0:
+        return unknown_command(cmd, state)
 
+    trace(TRACE_COMMANDS, "Select Paper Path: tray={:02x}, number(yy)={:02x}",
+        cmd.parameters[1], cmd.parameters[2]
+    )
 
-        elif cmd.name == '(e' and cmd.parameters[0] == 0:
-            print("Printer dotsize: {}".format(cmd.parameters[1]))
 
+@command_handler("@")
+def _reset(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Printer reset")
+    state.graphics = False
+    state.remote = False
+    state.printing = False
+
+
+@command_handler("\r")
+def _carriage_return(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "\n\n\nPrinter carriage return (back to the start of the line)\n\n")
+    state.headleft = 0
+    state.graphics = False
+    state.remote = False
+    state.printing = False
+    trace(TRACE_BYTES, " ", end="", file=sys.stderr)
+
+
+@command_handler("\x0c")
+def _form_feed(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Form feed (end of the page)")
+    state.headtop = INITIAL_HEADTOP
+    state.headleft = 0
+    state.page_end = True
+
+
+@command_handler("(R")
+def _remote_mode(cmd: Command, state: PrinterState):
+    if cmd.parameters != b'\x00REMOTE1':
+        return unknown_command(cmd, state)
+
+    trace(TRACE_COMMANDS, "Entering remote mode.")
+    state.remote = True
+
+
+@command_handler("(G")
+def _graphics_mode(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 1:
+        return unknown_command(cmd, state)
+
+    trace(TRACE_COMMANDS, "Graphics Mode Enabled")
+    state.graphics = True
+
+
+@command_handler("(U")
+def _units(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) == 1:
+        value = cmd.parameters[0]
+        trace(TRACE_COMMANDS, "Basic Unit of Measurement (multiples of 1/3600 inch)")
+        trace(TRACE_COMMANDS, "aka the printer DPI")
+        trace(TRACE_COMMANDS, "setting value to {} ({} dpi)", value, 3600/value)
+        pageunit = vunit = hunit = value/3600
+    elif len(cmd.parameters) == 5:
+        pageunit = cmd.parameters[0]
+        vunit = cmd.parameters[1]
+        hunit = cmd.parameters[2]
+        baseunit = cmd.parameters[3] + cmd.parameters[4]*256
+        trace(TRACE_COMMANDS, "Basic Unit of Measurement (multiples of 1/BASEUNIT inch)")
+        trace(TRACE_COMMANDS, "aka the printer DPI")
+        trace(TRACE_COMMANDS, "pageunit={}, vunit={}, hunit={}, baseunit={}",
+            pageunit, vunit, hunit, baseunit
+        )
+        trace(TRACE_COMMANDS, "dpis: pageunit={}, vunit={}, hunit={}",
+            baseunit/pageunit, baseunit/vunit, baseunit/hunit
+        )
+
+        # We save the units in inches, not in terms of baseunits, because we
+        # want to treat all values the same, and depending on the command,
+        # the scale changes.
+
+        vunit = vunit / baseunit
+        hunit = hunit / baseunit
+        pageunit = pageunit / baseunit
+    else:
+        return unknown_command(cmd, state)
 
-        elif cmd.name == '(v' and len(cmd.parameters) in [2,4]:
-            print(repr(cmd))
-            params = cmd.parameters
-            if len(params) == 2:
-                feed = params[0] + (params[1] << 8)
-            elif len(params) == 4:
-                feed = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
+    trace(TRACE_COMMANDS, "\tin inches: pageunit={}, vunit={}, hunit={}",
+          pageunit, vunit, hunit)
 
-            print("Advancing {} VUNITs vertically".format(feed))
-            print("\t aka {} inches".format(feed*state["vunits"]))
+    state.vunits = vunit
+    state.hunits = hunit
+    state.pageunits = pageunit
 
-            # We need to subtract the line count of the printer head?
-            state.update(
-                headtop = state["headtop"] + feed
-            )
 
-            print("\n{:04d}| ".format(state["headtop"]), end="", file=sys.stderr)
-            print("<< Head is now at pageunit {} {} >>".format(state["headtop"], state["headleft"]))
+@command_handler("U")
+def _print_direction(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Print direction: {}",
+        "unidirectional" if cmd.parameters[0] == 1 else "bidirectional"
+    )
+    state.unidirectional = cmd.parameters[0] == 1
 
 
-        elif cmd.name == '($' and len(cmd.parameters) == 4:
-            print(repr(cmd))
-            params = cmd.parameters
-            feed = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
+@command_handler("(d")
+def _unknown_d(cmd: Command, state: PrinterState):
+    # We have a (d command, but omitting it caused no changes to the actual
+    # printing process.
+    trace(TRACE_COMMANDS, "Unknown command (d with params len {}",
+          len(cmd.parameters))
 
-            print("Advancing {} HUNITs horizontally".format(feed))
-            print("\t aka {} inches".format(feed*state["hunits"]))
 
-            state.update(
-                headleft = state["headleft"] + feed
-            )
+@command_handler("(i")
+def _interleave(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Interleave mode enabled (mode {})",
+        cmd.parameters[0]
+    )
 
-            print("<< Head is now at pageunit {} {} >>".format(state["headtop"], state["headleft"]))
 
+@command_handler("(C")
+def _page_length(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) not in [2,4]:
+        return unknown_command(cmd, state)
 
-        elif cmd.name == 'i':
-            import math
+    trace(TRACE_COMMANDS, "{!r}", cmd)
+    params = cmd.parameters
+    if len(params) == 2:
+        length = params[0] + (params[1] << 8)
+    elif len(params) == 4:
+        length = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
 
-            print("Printing data")
-            color = cmd.parameters[0]
-            compress= cmd.parameters[1]
-            bits = cmd.parameters[2]
-            pbytes = cmd.parameters[3] + (cmd.parameters[4] << 8)
-            plines= cmd.parameters[5] + (cmd.parameters[6] << 8)
+    trace(TRACE_COMMANDS, "Page length: {} pageunits", length)
+    trace(TRACE_COMMANDS, "\t this means {} inches", length*state.pageunits)
 
-            print("\t color={}, compress={}, bpp={}, bytesline={}, lines={}".format(
-                color, compress, bits, pbytes, plines
-            ))
 
-            # Remember that this is the uncompressed total size!!!
-            # not the received.
-            #
-            # So we need to uncompress until we get this size, if the compression
-            # is enabled.
-            #
-            # After this line, we usually have a \r to move the printer head, or
-            # a (v to move it down.
-            toread = pbytes*plines
+@command_handler("(c")
+def _page_margin(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) not in [4,8]:
+        return unknown_command(cmd, state)
 
-            printing = True
-            printinfo = dict(color=color, compress=compress,
-                             bpp=bits, bytesline=pbytes, lines=plines, toread=toread)
+    params = cmd.parameters
+    top = 0
+    pagelength = 0
 
-        else:
-            print("unknown command evaluated: ", repr(cmd))
+    if len(params) == 2:
+        top = params[0] + (params[1] << 8)
+        pagelength = params[2] + (params[3] << 8)
+    elif len(params) == 4:
+        top = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
+        pagelength = params[4] + (params[5] << 8) + (params[6] << 16) + (params[7] << 24)
 
+    trace(TRACE_COMMANDS, "Vertical page margin in pageunits: top={}, pagelength={}", top, pagelength)
+    trace(TRACE_COMMANDS, "\t in inches: top={}, pagelength={}", top*state.pageunits,
+                                                       pagelength*state.pageunits)
 
-    state.update(
-        remote=remote,
-        printing=printing,
-        graphics=graphics,
 
+@command_handler("(S")
+def _page_size(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) != 8:
+        return unknown_command(cmd, state)
 
-        printinfo=printinfo
-    )
-    return state
+    trace(TRACE_COMMANDS, "{!r}", cmd)
+    params = cmd.parameters
+    width = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
+    length = params[4] + (params[5] << 8) + (params[6] << 16) + (params[7] << 24)
 
-from PIL import Image
+    trace(TRACE_COMMANDS, "Printed page size in pageunits: width={}, length={}", width, length)
+    trace(TRACE_COMMANDS, "\t in inches: width={}, length={}", width*state.pageunits,
+                                                     length*state.pageunits)
 
+    state.pagelen = length
+    state.pagewidth = width
 
 
-def plot_to_image(image: Image, imgx: int, imgy: int, width: int,
-                  height: int, inkcolor: int, buf: bytes, bpp: int) -> Image:
-    import math
+@command_handler("(K")
+def _color_mode(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 0 or len(cmd.parameters) != 2:
+        return unknown_command(cmd, state)
 
-    """
-    Plot an to-be-printed image, from the buffer 'buf' into 'image',
-    in the specified position, and using the specified inkcolor.
-    """
+    trace(TRACE_COMMANDS, "Setting color mode: ", end='')
+    mode = cmd.parameters[1]
+    if mode == 1:
+        trace(TRACE_COMMANDS, "grayscale")
+    elif mode in [0,2]:
+        trace(TRACE_COMMANDS, "color ({})", mode)
+    else:
+        trace(TRACE_COMMANDS, "unknown ({})", mode)
 
-    def split_color(colorhex):
-        colorhex = colorhex.replace("#", "")
-        r, g, b = (colorhex[0:2], colorhex[2:4], colorhex[4:6])
 
-        return [int(r, 16), int(g, 16), int(b, 16)]
+@command_handler("(D")
+def _nozzle_spacing(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) != 4:
+        return unknown_command(cmd, state)
 
-    def generate_color(hexmin, hexmax, proportion):
-        cmin = split_color(hexmin)
-        cmax = split_color(hexmax)
-        pinv = 1-proportion
+    params = cmd.parameters
+    baseunit = params[0] + (params[1] << 8) #baseunit must be 14400
+    vertical = params[2]
+    horizontal = params[3]
 
-        return [
-            int(cmin[0]*proportion + cmax[0]*pinv),
-            int(cmin[1]*proportion + cmax[1]*pinv),
-            int(cmin[2]*proportion + cmax[2]*pinv)
-        ]
+    trace(TRACE_COMMANDS, "Setting printer horizontal and vertical spacing")
+    trace(TRACE_COMMANDS, "baseunit={} (should be 14400), vertical={}, horizontal={}",
+        baseunit, vertical, horizontal
+    )
 
+    nozzle_horizontal = horizontal / baseunit
+    nozzle_vertical = vertical * 720 / baseunit
 
-    # min and max values for this cartridge
-    inkvalues = [
-        ["#000000", "#ffffff"], # black
-        ["#ff00ff", "#ffffff"], # magenta
-        ["#00ffff", "#ffffff"], # cyan
-        ["#000000", "#ffffff"], # ????
-        ["#ffff00", "#ffffff"], # yellow
-        ["#111111", "#ffffff"], # alternate black
-        ["#222222", "#ffffff"], # alternate black
-    ]
+    trace(TRACE_COMMANDS, "nozzle distance (in inches): vertical=1/{}, horizontal=1/{}",
+        nozzle_horizontal, nozzle_vertical
+    )
 
-    for py in range(int(height)):
-        for px in range(int(width)):
-            offset = math.ceil((py*width+px))
+    # What exactly is this above?
 
-# The correct way, sort of
-#            offset = math.ceil((py*width+px)*bpp/8)
-            if bpp == 2:
-                byteoffset = int(offset/4)
-                bitoffset = offset%4
 
-                masks = [0b00000011, 0b00001100,
-                         0b00110000, 0b11000000]
+@command_handler("(e")
+def _dot_size(cmd: Command, state: PrinterState):
+    if cmd.parameters[0] != 0:
+        return unknown_command(cmd, state)
 
-#                value = buf[byteoffset] & 0x4
-                value = (buf[byteoffset] >> (bitoffset*2)) & 0x3
-            elif bpp == 8:
-                value = buf[offset]
-            else:
-                raise RuntimeError(f"bpp {bpp} not handled!")
+    trace(TRACE_COMMANDS, "Printer dotsize: {}", cmd.parameters[1])
 
 
-            proportion = value / ((1 << bpp) - 1)
-            cartridge = inkvalues[inkcolor]
-            color = generate_color(cartridge[0], cartridge[1], proportion)
+@command_handler("(v")
+def _vertical_feed(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) not in [2,4]:
+        return unknown_command(cmd, state)
 
+    trace(TRACE_COMMANDS, "{!r}", cmd)
+    params = cmd.parameters
+    if len(params) == 2:
+        feed = params[0] + (params[1] << 8)
+    elif len(params) == 4:
+        feed = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
 
-            try:
-                r, g, b = image.getpixel((imgx+px, imgy+(py*2)))
+    trace(TRACE_COMMANDS, "Advancing {} VUNITs vertically", feed)
+    trace(TRACE_COMMANDS, "\t aka {} inches", feed*state.vunits)
 
-                # emulate printing on paper
-                # on printer world, colors subtract, not add
-                r -= 255-color[0]
-                g -= 255-color[1]
-                b -= 255-color[2]
+    # We need to subtract the line count of the printer head?
+    state.headtop += feed
 
-                image.putpixel((imgx+px, imgy+(py*2)), (r, g, b))
+    trace(TRACE_BYTES, "\n{:04d}| ", state.headtop, end="", file=sys.stderr)
+    trace(TRACE_COMMANDS, "<< Head is now at pageunit {} {} >>", state.headtop, state.headleft)
 
-                if py < height-1:
-                    image.putpixel((imgx+px, imgy+(py*2)+1), (r, g, b))
 
-#                if py == 0:
-#                    image.putpixel((imgx+px, imgy+py), (127, 0, 0))
-#
-#                if py == height-1:
-#                    image.putpixel((imgx+px, imgy+py), (0, 0, 127))
+@command_handler("(V")
+def _vertical_position(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) not in [2,4]:
+        return unknown_command(cmd, state)
 
+    params = cmd.parameters
+    if len(params) == 2:
+        position = params[0] + (params[1] << 8)
+    elif len(params) == 4:
+        position = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
 
-            except IndexError:
-                continue
+    trace(TRACE_COMMANDS, "Moving to {} VUNITs from the top", position)
 
+    # The position is absolute, so count it from where the head starts.
+    state.headtop = INITIAL_HEADTOP + position
 
-    return image
+    trace(TRACE_BYTES, "\n{:04d}| ", state.headtop, end="", file=sys.stderr)
+    trace(TRACE_COMMANDS, "<< Head is now at pageunit {} {} >>", state.headtop, state.headleft)
 
 
-imageout = None
+@command_handler("($")
+def _horizontal_feed(cmd: Command, state: PrinterState):
+    if len(cmd.parameters) != 4:
+        return unknown_command(cmd, state)
 
-with open("out.epson", "rb") as instream:
-    parse_until_enable_printing(instream)
-    print("printer initialized (at position {0} ({0:02x}))".format(instream.tell()), file=sys.stderr)
+    trace(TRACE_COMMANDS, "{!r}", cmd)
+    params = cmd.parameters
+    feed = params[0] + (params[1] << 8) + (params[2] << 16) + (params[3] << 24)
 
-    state = dict(
-        remote=False,
-        printing=False,
-        graphics=False,
+    trace(TRACE_COMMANDS, "Advancing {} HUNITs horizontally", feed)
+    trace(TRACE_COMMANDS, "\t aka {} inches", feed*state.hunits)
 
-        pageunits=0,
+    state.headleft += feed
 
-        # The page size, expressed in PAGEUNITS
-        pagelen=0,
-        pagewidth=0,
+    trace(TRACE_COMMANDS, "<< Head is now at pageunit {} {} >>", state.headtop, state.headleft)
 
-        # The printer head current location
-        headtop=-80,
-        headleft=0,
 
-        previous_color=None,
+@command_handler("i")
+def _print_band(cmd: Command, state: PrinterState):
+    trace(TRACE_COMMANDS, "Printing data")
+    color = cmd.parameters[0]
+    compress= cmd.parameters[1]
+    bits = cmd.parameters[2]
+    pbytes = cmd.parameters[3] + (cmd.parameters[4] << 8)
+    plines= cmd.parameters[5] + (cmd.parameters[6] << 8)
 
-        # How much the head will walk after each draw operation
-        headstep=0
+    trace(TRACE_COMMANDS, "\t color={}, compress={}, bpp={}, bytesline={}, lines={}",
+        color, compress, bits, pbytes, plines
     )
 
-    command_buf = b''
+    # Remember that this is the uncompressed total size!!!
+    # not the received.
+    #
+    # So we need to uncompress until we get this size, if the compression
+    # is enabled.
+    #
+    # After this line, we usually have a \r to move the printer head, or
+    # a (v to move it down.
+    toread = pbytes*plines
 
-    char = True
-    while True:
-        remote = state.get('remote')
-        printing = state.get('printing')
+    state.printing = True
+    state.printinfo = dict(color=color, compress=compress,
+                           bpp=bits, bytesline=pbytes, lines=plines, toread=toread)
+
+
+@dataclass
+class Band:
+    """
+    A band of dots, placed on the page
+    """
+    x: int
+    y: int
+    width: int
+    height: int
+    color: int
+    bpp: int
+    data: bytes = field(repr=False)
 
-        if printing is True:
-            if imageout is None:
-                imageout = Image.new("RGB", (state["pagewidth"], state["pagelen"]),
-                                     (255, 255, 255))
 
-            printinfo = state["printinfo"]
-            toread = printinfo.get('toread', 0)
+def band_offset(color: int) -> int:
+    """
+    Return how far above the printer head the bands of an ink color land
+    """
+    # Add those random offsets to certain ink types
+    # The row count is 60, and they are multiples of the row count, so they
+    # probably are related
+    #
+    # Probably the printer process them 4 lines at a time?
+    # Or it has different starting offsets for each color (this actually makes more sense)
+    if color == 5:
+        return -120
+    elif color == 6:
+        return -240
+    elif color == 1:
+        return -120
+    elif color == 4:
+        return -240
+    else:
+        return 0
+
 
-            if printinfo["compress"] == 0:
-                print("\tReceiving uncompressed data")
-                data = instream.read(toread)
-            elif printinfo["compress"] == 1:
-                print("\tReceiving packbits compressed data")
+def band_from_state(state: PrinterState, data) -> Band:
+    """
+    Place the band described by state.printinfo at the printer head
+    position.
+    """
+    printinfo = state.printinfo
 
-                data = b''
-                error = False
-                while len(data) < toread:
-                    recv = instream.read(1)
-                    if len(recv) == 0:
-                        error = True
-                        break
+    trace(TRACE_BYTES, "{}", printinfo["color"], end="", file=sys.stderr)
 
-                    if recv[0] > 0x80:
-                        recv += instream.read(1)
-                    elif recv[0] >= 0x0 and recv[0] < 0x80:
-                        recv += instream.read(recv[0]+1)
+    extraY = band_offset(printinfo["color"])
 
+    # Width of the row, in hunits.
+    rowwidth = printinfo["bytesline"] * 8 / printinfo["bpp"]
+    rowheight = printinfo["lines"]
+    trace(TRACE_COMMANDS, "rowwidth: {}", rowwidth)
 
-                    data += decode_packbits(recv)
+    # state.headleft += rowwidth
+    state.previous_color = printinfo["color"]
 
-            print("\tNow position is {:04x}".format(instream.tell()))
-            print("\tPrinting data: ", len(data))
+    return Band(state.headleft, int(state.headtop+extraY), int(rowwidth),
+                rowheight, printinfo["color"], printinfo["bpp"], data)
 
-            state["printing"] = False
 
-            vert_spacing = 80
+# What PageSplitter.events yields for each command: any command, a command
+# that printed a band, a form feed that ends a page, and a form feed after
+# nothing (no band, and no page size), so no page comes out
+EVENT_COMMAND = 0
+EVENT_BAND = 1
+EVENT_PAGE = 2
+EVENT_BLANK = 3
 
 
-            previous_color = state["previous_color"]
+class PageSplitter:
+    """
+    Runs the commands of a job, and tells where its pages start and end, so
+    everything going through a job (PageRenderer, index_job, inspect_job,
+    estimate_job) splits the pages the same way.
+
+    A page ends with a form feed, and comes out if a band was printed on
+    it, or if there is a page size. 'events' can be called again with more
+    commands (of a lexer that was fed more data), and 'finish' says if a
+    last page, without a form feed, comes out at the end of the job.
+    """
 
-            print("{}".format(printinfo["color"]), end="", file=sys.stderr)
+    def __init__(self, state: PrinterState):
+        self.state = state
 
+        # If a band was printed since the last page
+        self.drawn = False
 
-            # Add those random offsets to certain ink types
-            # The row count is 60, and they are multiples of the row count, so they
-            # probably are related
-            #
-            # Probably the printer process them 4 lines at a time?
-            # Or it has different starting offsets for each color (this actually makes more sense)
-            if printinfo["color"] == 5:
-                extraY = -120
-            elif printinfo["color"] == 6:
-                extraY = -240
-            elif printinfo["color"] == 1:
-                extraY = -120
-            elif printinfo["color"] == 4:
-                extraY = -240
+    def events(self, commands, evaluate=eval_command) -> Iterator[tuple[int, Command, PrinterState]]:
+        """
+        Evaluate each of 'commands' (with 'evaluate'), and yield what it did
+        (one of the EVENT_* values), the command and the printer state after
+        it. The state of a band is left with 'printing' cleared.
+        """
+        state = self.state
+        for cmd in commands:
+            state = self.state = evaluate(cmd, state)
+
+            if state.page_end is True:
+                if self.drawn or (state.pagelen > 0 and state.pagewidth > 0):
+                    yield EVENT_PAGE, cmd, state
+                else:
+                    yield EVENT_BLANK, cmd, state
+
+                self.drawn = False
+            elif state.printing is True:
+                state.printing = False
+                self.drawn = True
+                yield EVENT_BAND, cmd, state
             else:
-                extraY = 0
+                yield EVENT_COMMAND, cmd, state
 
-            # Width of the row, in hunits.
-            rowwidth = printinfo["bytesline"] * 8 / printinfo["bpp"]
-            rowheight = printinfo["lines"]
-            print("rowwidth:", rowwidth)
-            imageout = plot_to_image(imageout, state["headleft"],
-                                     int(state["headtop"]+extraY),
-                                     rowwidth,
-                                     rowheight, printinfo["color"],
-                                     data,
-                                     printinfo["bpp"])
+    def finish(self) -> bool:
+        """
+        Say if a last page comes out at the end of the job
+        """
+        drawn = self.drawn
+        self.drawn = False
+        return drawn
 
 
-            # state["headleft"] += rowwidth
-            state["previous_color"] = printinfo["color"]
+class PageRenderer:
+    """
+    Turns printer commands into pages.
 
-            continue
+    'run' goes through the commands of a lexer, yielding each page as soon as
+    it is finished (by a form feed). 'finish' yields the last page, at the
+    end of the data.
 
+    A page is a (4, pagelen, pagewidth) array, with how much of the paper
+    each of the C, M, Y and K inks covers (epsonraster.composite turns it
+    into RGB). We drop it when the next page starts, so only one page is in
+    memory at a time.
 
-        char = instream.read(1)
+    With an executor, the bands of each page are kept until the page ends,
+    and then rasterized in parallel, on 'jobs' processes.
 
-        if len(char) == 0:
-            if len(command_buf) > 0:
-                cmd = Command.parse_normal(command_buf)
-                if cmd is not None:
-                    eval_command(cmd, state)
-            break
+    Pages bigger than 'pagelimit' bytes are drawn on a temporary file (see
+    epsonraster.new_page). Without an executor, the bands are plotted through
+    the epsonraster.BandCache 'cache', if there is one.
 
-        if char == b'\x1b' and remote is False:
-            pass
-            #print("command incoming (at pos {0} ({0:02x}))".format(instream.tell()), file=sys.stderr)
-        else:
-            command_buf += char
+    With a 'scale' of 2, 4 or 8, the pages are previews that many times
+    smaller on each side (see epsonraster.plot_preview), always plotted
+    here, without the executor.
 
-        if remote is True:
-#            import time; time.sleep(0.09)
-            print(repr(char), repr(command_buf))
+    With a region of interest 'roi', a (left, top, right, bottom) rectangle
+    of the page, the pages are cut down to it. The commands are all still
+    run, but the bands that do not land on it are skipped by the lexer,
+    without being decoded, and are not rasterized.
+    """
 
-        if len(command_buf) > 0:
-            if remote is True:
-                command = Command.parse_remote(command_buf)
-            else:
-                command = Command.parse_normal(command_buf)
+    def __init__(self, state: PrinterState, executor=None, jobs: int = 1,
+                 pagelimit: Optional[int] = None, cache=None, scale: int = 1,
+                 roi: Optional[tuple[int, int, int, int]] = None):
+        self.splitter = PageSplitter(state)
+        self.executor = executor if scale == 1 else None
+        self.jobs = jobs
+        self.pagelimit = pagelimit
+        self.cache = cache
+        self.scale = scale
+        self.roi = roi
+
+        self.imageout = None
+        self.pagesize = None
+        self.bands = []
+
+    def run(self, lexer: CommandLexer) -> Iterator[np.ndarray]:
+        # The rasterizer is only loaded when we draw, so inspecting a job does
+        # not pay for numpy and PIL
+        from epsonraster import plot_band, plot_preview
+
+        if self.scale == 1:
+            plot = plot_band
+        else:
+            def plot(planes, band, cache=None):
+                return plot_preview(planes, band, self.scale, cache)
 
-            if command is not None:
-                state = eval_command(command, state)
-                command_buf = b''
+        if self.roi is not None:
+            lexer.decode = self._in_roi
 
+        # The profiler wraps what it times, so it costs nothing when it is
+        # off
+        profile = profiler
+        commands = lexer if profile is None else profile.lex(lexer)
+        evaluate = eval_command if profile is None else profile.eval_command
 
+        for event, cmd, state in self.splitter.events(commands, evaluate):
+            if event == EVENT_PAGE:
+                if self.pagesize is None:
+                    # Nothing was printed, but the page still comes out
+                    self.pagesize = (state.pagelen, state.pagewidth)
 
-imageout.save("out.png")
+                yield self._finish_page()
+                continue
+
+            if event != EVENT_BAND:
+                continue
+
+            if self.pagesize is None:
+                self.pagesize = (state.pagelen, state.pagewidth)
+                if self.executor is None:
+                    self.imageout = self._new_page()
+
+            printinfo = state.printinfo
+
+            if printinfo["compress"] == 0:
+                trace(TRACE_COMMANDS, "\tReceived uncompressed data")
+            elif printinfo["compress"] == 1:
+                trace(TRACE_COMMANDS, "\tReceived packbits compressed data")
+
+            data = cmd.payload
+            if data is None:
+                trace(TRACE_COMMANDS, "\tBand skipped, out of the region of interest")
+                continue
+
+            trace(TRACE_COMMANDS, "\tNow position is {:04x}", lexer.tell())
+            trace(TRACE_COMMANDS, "\tPrinting data: {}", len(data))
+
+            band = band_from_state(state, data)
+            if profile is not None:
+                if self.executor is None:
+                    self.imageout = profile.band(band, plot, self.imageout,
+                                                 cache=self.cache)
+                else:
+                    profile.band(band)
+                    self.bands.append(band)
+            elif self.executor is None:
+                self.imageout = plot(self.imageout, band, cache=self.cache)
+            else:
+                self.bands.append(band)
+
+    @property
+    def state(self) -> PrinterState:
+        return self.splitter.state
+
+    def finish(self) -> Iterator[np.ndarray]:
+        if self.splitter.finish():
+            yield self._finish_page()
+
+    def _finish_page(self) -> np.ndarray:
+        from epsonraster import STRIPES_PER_JOB, rasterize_parallel
+
+        start = time.perf_counter()
+        if self.executor is not None:
+            page = rasterize_parallel(*self.pagesize, self.bands, self.executor,
+                                      self.jobs*STRIPES_PER_JOB, self.pagelimit)
+        elif self.imageout is None:
+            page = self._new_page()
+        else:
+            page = self.imageout
+
+        self.imageout = None
+        self.pagesize = None
+        self.bands = []
+
+        if self.roi is not None:
+            left, top, right, bottom = self.roi
+            scale = self.scale
+            page = page[:, top // scale:-(-bottom // scale),
+                        left // scale:-(-right // scale)]
+
+        if profiler is not None:
+            profiler.page(time.perf_counter() - start)
+
+        return page
+
+    def _in_roi(self, cmd: Command) -> bool:
+        """
+        Say if the band of an ESC i command, printed where the head is now,
+        lands on the region of interest
+        """
+        params = cmd.parameters
+        bpp = params[2]
+        if bpp == 0:
+            return True
+
+        state = self.state
+        top = int(state.headtop + band_offset(params[0]))
+        left = state.headleft
+        # Each row of the band covers two rows of the page
+        height = 2 * (params[5] + (params[6] << 8))
+        width = int((params[3] + (params[4] << 8)) * 8 / bpp)
+
+        roileft, roitop, roiright, roibottom = self.roi
+        return (_overlaps(top, top + height, roitop, roibottom, state.pagelen) and
+                _overlaps(left, left + width, roileft, roiright, state.pagewidth))
+
+    def _new_page(self) -> np.ndarray:
+        from epsonraster import new_page, preview_size
+
+        if self.scale > 1:
+            return new_page(*preview_size(*self.pagesize, self.scale), self.pagelimit)
+
+        return new_page(*self.pagesize, self.pagelimit)
+
+
+def _overlaps(start: int, end: int, low: int, high: int, size: int) -> bool:
+    """
+    Say if the span from 'start' to 'end' of a page axis of 'size' pixels
+    touches the one from 'low' to 'high', counting the negative coordinates,
+    that wrap around to the other end of the page
+    """
+    return (start < high and end > low) or (start < high - size and end > low - size)
+
+
+def render_pages(lexer: CommandLexer, state: PrinterState, jobs: int = 1,
+                 pagelimit: Optional[int] = None, cache=None, scale: int = 1,
+                 roi: Optional[tuple[int, int, int, int]] = None) -> Iterator[np.ndarray]:
+    """
+    Run the commands from 'lexer', and yield each page as soon as it is
+    finished (by a form feed, or by the end of the data).
+
+    With more than one job, each page is rasterized in parallel, by that many
+    processes. With a 'scale', the pages are previews that many times
+    smaller, always rasterized here. With a region of interest 'roi', only
+    that rectangle of the pages is rendered (see PageRenderer).
+    """
+    if jobs > 1 and scale == 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            renderer = PageRenderer(state, executor, jobs, pagelimit, roi=roi)
+            yield from renderer.run(lexer)
+            yield from renderer.finish()
+    else:
+        renderer = PageRenderer(state, pagelimit=pagelimit, cache=cache, scale=scale,
+                                roi=roi)
+        yield from renderer.run(lexer)
+        yield from renderer.finish()
+
+
+# How much we read from the socket at a time
+RECV_SIZE = 65536
+
+
+# The formats the pages can be saved in, and their extensions. PPM and TIFF
+# are not compressed, and .npy has the coverage planes (see
+# epsonraster.write_page).
+OUTPUT_FORMATS = {
+    "png": ".png",
+    "ppm": ".ppm",
+    "tiff": ".tif",
+    "npy": ".npy",
+}
+
+
+async def serve(host: str, port: int, prefix: str, jobs: int = 1,
+                pagelimit: Optional[int] = None, cache: bool = False,
+                format: str = "png", level: Optional[int] = None,
+                writers: int = 1):
+    """
+    Listen on the printer port, like the real printer, rendering the jobs we
+    receive while they arrive.
+
+    The pages of each job are written to PREFIX-jobNNNN-NNNN.png (or the
+    extension of 'format') as soon as they are finished, by 'writers'
+    threads.
+
+    With 'cache', the bands that repeat, on any job, are only unpacked once.
+    """
+    import asyncio
+
+    from epsonraster import BandCache, PageWriter
+
+    bandcache = BandCache() if cache else None
+    pagewriter = PageWriter(writers, level)
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    jobcount = 0
+
+    async def handle_job(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        nonlocal jobcount
+        jobcount += 1
+        jobprefix = "{}-job{:04d}".format(prefix, jobcount)
+
+        trace(TRACE_SUMMARY, "job accepted from {}!", writer.get_extra_info("peername"),
+              file=sys.stderr)
+
+        lexer = CommandLexer(final=False)
+        renderer = PageRenderer(PrinterState(), executor, jobs, pagelimit,
+                                bandcache)
+        pageno = 0
+
+        def render(msg: bytes):
+            # Runs on a thread, so the other jobs are not held up
+            nonlocal pageno
+
+            if len(msg) > 0:
+                lexer.feed(msg)
+                pages = list(renderer.run(lexer))
+            else:
+                lexer.close()
+                pages = list(renderer.run(lexer)) + list(renderer.finish())
+
+            for page in pages:
+                pageno += 1
+                pagepath = "{}-{:04d}{}".format(jobprefix, pageno, OUTPUT_FORMATS[format])
+                pagewriter.write(page, pagepath, page_written)
+
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                msg = await reader.read(RECV_SIZE)
+                await loop.run_in_executor(None, render, msg)
+
+                if len(msg) == 0:
+                    break
+
+            trace(TRACE_SUMMARY, "Received everything.", file=sys.stderr)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    server = await asyncio.start_server(handle_job, host, port)
+    trace(TRACE_SUMMARY, "listening to {}:{}", host, port, file=sys.stderr)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        pagewriter.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+def page_written(path: str, elapsed: float):
+    """
+    Tell that a page was written, taking 'elapsed' seconds (called by
+    epsonraster.PageWriter)
+    """
+    if profiler is not None:
+        profiler.pagewrite.append(elapsed)
+
+    trace(TRACE_SUMMARY, "{} written in {:.3f} s", path, elapsed, file=sys.stderr)
+
+
+def map_dump(path: str) -> mmap.mmap:
+    """
+    Map the dump of a print job, read only. An empty dump raises EOFError.
+    """
+    with open(path, "rb") as instream:
+        try:
+            return mmap.mmap(instream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise EOFError("{} is empty".format(path)) from None
+
+
+def open_dump(path: str, decode: bool = True,
+              job: Optional[tuple[int, int]] = None) -> CommandLexer:
+    """
+    Map the dump of a print job, and return a lexer for the commands after
+    its printing preamble.
+
+    With 'job', the (offset, length) of one of the jobs of a capture (see
+    split_jobs), the lexer only goes through that job.
+
+    A dump without the preamble raises EOFError.
+    """
+    dump = map_dump(path)
+    if job is not None:
+        dump.seek(job[0])
+
+    try:
+        parse_until_enable_printing(dump)
+    except EOFError:
+        raise EOFError("{} has no printing preamble".format(path)) from None
+
+    trace(TRACE_SUMMARY, "printer initialized (at position {0} ({0:02x}))", dump.tell(),
+          file=sys.stderr)
+
+    # The lexer hands the band data out as slices of the dump, so nothing is
+    # copied
+    if job is not None:
+        return CommandLexer(memoryview(dump)[:job[0] + job[1]], pos=dump.tell(),
+                            decode=decode)
+
+    return CommandLexer(dump, pos=dump.tell(), decode=decode)
+
+
+class JobIndex:
+    """
+    Where the commands, bands and pages of a dump are.
+
+    'commands' and 'bands' have the offset of each command and of each band
+    (ESC i) command. Page N starts at pagestart[N] and ends at pageend[N],
+    right after its form feed, and the printer state at its start is kept,
+    so it can be rendered without going through the pages before it.
+
+    The index is saved next to the dump (see load_index), as arrays, and is
+    only good for a dump of the same size and time.
+    """
+
+    MAGIC = b"EPIX"
+    VERSION = 2
+
+    # Magic, version, dump size and mtime (in ns), and how many commands,
+    # bands and pages there are
+    HEADER = struct.Struct("<4sH2xQqQQQ")
+
+    # The state kept for each page start. The flags are the STATE_FLAGS set,
+    # and a previous_color of None is kept as -1.
+    STATE_INTS = ("flags", "pagelen", "pagewidth", "headtop", "headleft",
+                  "headstep", "previous_color")
+    STATE_FLOATS = ("pageunits", "vunits", "hunits")
+    STATE_FLAGS = ("remote", "graphics", "printing", "unidirectional")
+
+    # Set on the flags when the lexer is on remote mode
+    LEXER_REMOTE = 1 << len(STATE_FLAGS)
+
+    def __init__(self, size: int = 0, mtime: int = 0):
+        self.size = size
+        self.mtime = mtime
+
+        self.commands = array("Q")
+        self.bands = array("Q")
+        self.pagestart = array("Q")
+        self.pageend = array("Q")
+        self.stateints = array("q")
+        self.statefloats = array("d")
+
+    def __len__(self) -> int:
+        return len(self.pagestart)
+
+    def add_page(self, start: int, end: int, state: tuple):
+        """
+        Add a page, with the state taken by 'snapshot' at its start
+        """
+        self.pagestart.append(start)
+        self.pageend.append(end)
+        self.stateints.extend(state[0])
+        self.statefloats.extend(state[1])
+
+    @classmethod
+    def snapshot(cls, state: PrinterState, lexer: CommandLexer) -> tuple:
+        """
+        Take what add_page needs of the printer and lexer state
+        """
+        flags = sum(1 << bit for bit, name in enumerate(cls.STATE_FLAGS)
+                    if getattr(state, name))
+        if lexer.remote:
+            flags |= cls.LEXER_REMOTE
+
+        ints = [flags] + [getattr(state, name) for name in cls.STATE_INTS[1:-1]]
+        ints.append(-1 if state.previous_color is None else state.previous_color)
+
+        return ints, [getattr(state, name) for name in cls.STATE_FLOATS]
+
+    def page_state(self, pageno: int) -> tuple[PrinterState, bool]:
+        """
+        Return the printer state at the start of page 'pageno' (from 0), and
+        whether the lexer is on remote mode there
+        """
+        ints = self.stateints[pageno*len(self.STATE_INTS):(pageno+1)*len(self.STATE_INTS)]
+        floats = self.statefloats[pageno*len(self.STATE_FLOATS):(pageno+1)*len(self.STATE_FLOATS)]
+
+        values = dict(zip(self.STATE_INTS, ints))
+        values.update(zip(self.STATE_FLOATS, floats))
+
+        flags = values.pop("flags")
+        for bit, name in enumerate(self.STATE_FLAGS):
+            values[name] = bool(flags & (1 << bit))
+
+        if values["previous_color"] == -1:
+            values["previous_color"] = None
+
+        return PrinterState(**values), bool(flags & self.LEXER_REMOTE)
+
+    def page_at(self, offset: int) -> int:
+        """
+        Return the page (from 0) that has the byte at 'offset', or -1 if it
+        is before the first page
+        """
+        pageno = bisect_right(self.pagestart, offset) - 1
+        if pageno >= 0 and offset >= self.pageend[pageno]:
+            # Between the pages, so it goes with the next one
+            pageno += 1
+
+        return min(pageno, len(self) - 1)
+
+    def page_bands(self, pageno: int) -> range:
+        """
+        Return the indexes, on 'bands', of the bands of page 'pageno'
+        """
+        first = bisect_right(self.bands, self.pagestart[pageno] - 1)
+        last = bisect_right(self.bands, self.pageend[pageno] - 1)
+        return range(first, last)
+
+    def open(self, dump, first: int, last: int,
+             decode: bool = True) -> tuple[CommandLexer, PrinterState]:
+        """
+        Return a lexer for the commands of pages 'first' to 'last' (from 0)
+        of the mapped 'dump', and the printer state it starts from
+        """
+        state, remote = self.page_state(first)
+
+        # The lexer stops at the end of the last page
+        lexer = CommandLexer(memoryview(dump)[:self.pageend[last]],
+                             pos=self.pagestart[first], decode=decode)
+        lexer.remote = remote
+
+        return lexer, state
+
+    def save(self, path: str):
+        with open(path, "wb") as out:
+            out.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.size,
+                                       self.mtime, len(self.commands),
+                                       len(self.bands), len(self)))
+            for values in (self.commands, self.bands, self.pagestart,
+                           self.pageend, self.stateints, self.statefloats):
+                values.tofile(out)
+
+    @classmethod
+    def load(cls, path: str) -> Optional[JobIndex]:
+        """
+        Read an index saved by 'save', or return None if it is not one
+        """
+        with open(path, "rb") as instream:
+            header = instream.read(cls.HEADER.size)
+            if len(header) < cls.HEADER.size:
+                return None
+
+            magic, version, size, mtime, commands, bands, pages = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                return None
+
+            index = cls(size, mtime)
+            try:
+                index.commands.fromfile(instream, commands)
+                index.bands.fromfile(instream, bands)
+                index.pagestart.fromfile(instream, pages)
+                index.pageend.fromfile(instream, pages)
+                index.stateints.fromfile(instream, pages*len(cls.STATE_INTS))
+                index.statefloats.fromfile(instream, pages*len(cls.STATE_FLOATS))
+            except EOFError:
+                return None
+
+        return index
+
+
+def index_job(lexer: CommandLexer, state: PrinterState, index: JobIndex) -> JobIndex:
+    """
+    Run the commands from 'lexer' without drawing anything, adding them to
+    'index'.
+
+    The pages are split by PageSplitter, as PageRenderer splits them.
+    """
+    start = lexer.tell()
+    snapshot = index.snapshot(state, lexer)
+    splitter = PageSplitter(state)
+
+    for event, cmd, state in splitter.events(lexer):
+        index.commands.append(cmd.offset)
+
+        if event == EVENT_BAND:
+            index.bands.append(cmd.offset)
+        elif event in (EVENT_PAGE, EVENT_BLANK):
+            if event == EVENT_PAGE:
+                index.add_page(start, lexer.tell(), snapshot)
+
+            start = lexer.tell()
+            snapshot = index.snapshot(state, lexer)
+
+    if splitter.finish():
+        index.add_page(start, lexer.tell(), snapshot)
+
+    return index
+
+
+def load_index(path: str) -> JobIndex:
+    """
+    Return the index of the dump on 'path'.
+
+    It is read from PATH.idx, unless the dump changed since it was written;
+    then the dump is indexed again, and PATH.idx rewritten.
+    """
+    info = os.stat(path)
+    indexpath = path + ".idx"
+
+    try:
+        index = JobIndex.load(indexpath)
+    except OSError:
+        index = None
+
+    if index is not None and (index.size, index.mtime) == (info.st_size, info.st_mtime_ns):
+        return index
+
+    # The commands were already traced by whoever asked for the index
+    level, sink = trace_level, trace_sink
+    set_trace(min(level, TRACE_SUMMARY))
+    try:
+        start = time.perf_counter()
+        lexer = open_dump(path, decode=False)
+        index = index_job(lexer, PrinterState(), JobIndex(info.st_size, info.st_mtime_ns))
+        elapsed = time.perf_counter() - start
+    finally:
+        set_trace(level, sink)
+
+    trace(TRACE_SUMMARY, "{} indexed in {:.3f} s: {} pages, {} bands, {} commands",
+          path, elapsed, len(index), len(index.bands), len(index.commands),
+          file=sys.stderr)
+
+    try:
+        index.save(indexpath)
+    except OSError as e:
+        trace(TRACE_SUMMARY, "Could not save the index: {}", e, file=sys.stderr)
+
+    return index
+
+
+def open_pages(path: str, pages: range, decode: bool = True) -> tuple[CommandLexer, PrinterState, range]:
+    """
+    Return a lexer for the commands of 'pages' (from 0) of the dump on
+    'path', found through its index, and the printer state it starts from.
+
+    The pages past the end of the dump are left out of the range returned.
+    If none is left, we raise EOFError.
+    """
+    index = load_index(path)
+
+    pages = range(pages.start, min(pages.stop, len(index)))
+    if len(pages) == 0:
+        raise EOFError("{} has only {} pages".format(path, len(index)))
+
+    lexer, state = index.open(map_dump(path), pages.start, pages.stop - 1, decode)
+    return lexer, state, pages
+
+
+def list_index(path: str):
+    """
+    Print where each page of the dump is, indexing it if needed
+    """
+    index = load_index(path)
+
+    print("{}: {} commands, {} bands".format(path, len(index.commands), len(index.bands)))
+    print("{:>6} {:>12} {:>12} {:>8}".format("page", "start", "end", "bands"))
+    for pageno in range(len(index)):
+        print("{:>6} {:>12} {:>12} {:>8}".format(
+            pageno + 1, index.pagestart[pageno], index.pageend[pageno],
+            len(index.page_bands(pageno))))
+
+
+@dataclass
+class RenderOptions:
+    """
+    How render_job renders a job
+    """
+    # Rasterize each page on this many processes
+    jobs: int = 1
+
+    # Draw pages bigger than this many bytes on a temporary file (by default,
+    # epsonraster.PAGE_MEMORY_LIMIT)
+    pagelimit: Optional[int] = None
+
+    # An epsonraster.BandCache, so the bands that repeat are only unpacked
+    # once. It can be shared by many jobs.
+    bandcache: object = None
+
+    # Render previews this many times smaller on each side (2, 4 or 8)
+    scale: int = 1
+
+    # Only render this (left, top, right, bottom) rectangle of the pages, in
+    # dots, skipping the bands that do not land on it
+    roi: Optional[tuple[int, int, int, int]] = None
+
+
+@dataclass
+class Page:
+    """
+    A page rendered by render_job
+    """
+    # From 1, on the job
+    number: int
+
+    # How much of the paper each of the C, M, Y and K inks covers, as a
+    # (4, pagelen, pagewidth) array
+    planes: np.ndarray = field(repr=False)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """
+        The page width and length, in dots
+        """
+        return self.planes.shape[2], self.planes.shape[1]
+
+    def image(self):
+        """
+        Return the page as an RGB PIL image
+        """
+        from PIL import Image
+        from epsonraster import composite
+
+        return Image.fromarray(composite(self.planes))
+
+    def save(self, path: str, level: Optional[int] = None):
+        """
+        Save the page in the format of the extension of 'path' (see
+        OUTPUT_FORMATS; PNG if it is none of them). PNG images are
+        compressed at zlib 'level'.
+        """
+        from epsonraster import PNG_LEVEL, write_page
+
+        write_page(self.planes, path, PNG_LEVEL if level is None else level)
+
+
+def render_job(source, options: Optional[RenderOptions] = None) -> Iterator[Page]:
+    """
+    Render a print job, yielding each page as soon as it is finished.
+
+    'source' is the job: bytes (or anything with the buffer protocol), the
+    path of a dump, or a binary stream, read as the pages are rendered. The
+    printing preamble comes first, as the driver sends it; a job without it
+    (or an empty dump) raises EOFError.
+
+    Only one page is kept at a time, so keep the planes of the pages you
+    need (a page bigger than options.pagelimit is on a temporary file, gone
+    when the page is).
+    """
+    if options is None:
+        options = RenderOptions()
+
+    if isinstance(source, (str, os.PathLike)):
+        lexer = open_dump(os.fspath(source))
+    elif hasattr(source, "read"):
+        rest = parse_until_enable_printing(source)
+        lexer = CommandLexer(final=False)
+        if rest:
+            lexer.feed(rest)
+    else:
+        pos = find_preamble(source)
+        if not isinstance(source, mmap.mmap):
+            source = memoryview(source).cast("B")
+
+        lexer = CommandLexer(source, pos=pos)
+
+    state = PrinterState()
+    if lexer.final:
+        pages = render_pages(lexer, state, options.jobs, options.pagelimit,
+                             options.bandcache, options.scale, options.roi)
+    else:
+        pages = _render_stream(source, lexer, state, options)
+
+    for number, planes in enumerate(pages, start=1):
+        yield Page(number, planes)
+
+
+def _render_stream(stream, lexer: CommandLexer, state: PrinterState,
+                   options: RenderOptions) -> Iterator[np.ndarray]:
+    executor = None
+    if options.jobs > 1 and options.scale == 1:
+        executor = ProcessPoolExecutor(options.jobs)
+
+    renderer = PageRenderer(state, executor, options.jobs, options.pagelimit,
+                            options.bandcache, options.scale, options.roi)
+    try:
+        while True:
+            data = stream.read(RECV_SIZE)
+            if not data:
+                break
+
+            lexer.feed(data)
+            yield from renderer.run(lexer)
+
+        lexer.close()
+        yield from renderer.run(lexer)
+        yield from renderer.finish()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+# How much disk the page cache can take, by default
+PAGE_CACHE_SIZE = 1 << 30
+
+
+class PageCache:
+    """
+    Disk cache of the pages rendered from whole jobs.
+
+    Each job has a directory on 'directory', named after the hash of its
+    bytes, with the files written for it (named without their prefix, so any
+    copy of the job finds them). The least recently used jobs are dropped
+    when the cache takes more than 'size' bytes.
+    """
+
+    def __init__(self, directory: str, size: int = PAGE_CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data: bytes, options: str = "") -> str:
+        """
+        Return the cache key of a job, rendered with 'options'.
+
+        The emulator code goes into the key too, so changing it does not
+        give us pages it would not render anymore.
+        """
+        digest = hashlib.sha256(options.encode())
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ("epsonserver.py", "epsonraster.py"):
+            with open(os.path.join(here, name), "rb") as source:
+                digest.update(source.read())
+
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[list]:
+        """
+        Return the files cached for 'key', or None if there are none
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+
+        # The directory times say which jobs were used last
+        os.utime(path)
+        self.hits += 1
+
+        return sorted(os.path.join(path, name) for name in os.listdir(path))
+
+    def put(self, key: str, files: list, prefix: str):
+        """
+        Cache copies of 'files' for 'key', named without the 'prefix' they
+        were written with. A job that can not be cached is left out.
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            # Another worker already cached the same job
+            return
+
+        # Copied aside and moved in place, so a half copied job is never
+        # taken from the cache
+        skip = len(os.path.basename(prefix)) + 1
+        try:
+            newpath = tempfile.mkdtemp(prefix=".new-", dir=self.directory)
+        except OSError as e:
+            trace(TRACE_SUMMARY, "Job not cached: {}", e, file=sys.stderr)
+            return
+
+        try:
+            for name in files:
+                shutil.copyfile(name, os.path.join(newpath, os.path.basename(name)[skip:]))
+
+            os.rename(newpath, path)
+        except OSError as e:
+            # Most likely cached by another worker meanwhile
+            shutil.rmtree(newpath, ignore_errors=True)
+            trace(TRACE_SUMMARY, "Job not cached: {}", e, file=sys.stderr)
+            return
+
+        self._evict()
+
+    def _evict(self):
+        jobs = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                jobs.append((os.path.getmtime(path), size, path))
+            except OSError:
+                # Dropped by another worker meanwhile
+                continue
+
+        used = sum(size for _, size, _ in jobs)
+        for _, size, path in sorted(jobs):
+            if used <= self.size:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            used -= size
+
+
+def render_dump(path: str, jobs: int = 1, planes: bool = False,
+                pagelimit: Optional[int] = None, cache: Optional[PageCache] = None,
+                pages: Optional[range] = None, prefix: str = "out",
+                format: str = "png", level: Optional[int] = None,
+                writers: int = 1, scale: int = 1,
+                roi: Optional[tuple[int, int, int, int]] = None,
+                job: Optional[tuple[int, int]] = None) -> list:
+    """
+    Render the dump of a print job to PREFIX-0001.png, PREFIX-0002.png...,
+    and return the files written.
+
+    With a 'scale' of 2, 4 or 8, the pages are previews that many times
+    smaller on each side. With a 'roi', only that (left, top, right, bottom)
+    rectangle of the pages is rendered.
+
+    The pages are saved in 'format' (see OUTPUT_FORMATS), PNG images
+    compressed at zlib 'level', by 'writers' threads while the next pages
+    are rendered (or right away, with no writers).
+
+    With 'planes', the ink coverage planes of each page are also saved, to
+    PREFIX-0001.npy, PREFIX-0002.npy...
+
+    With a 'cache', a job that was rendered before is copied from it, and the
+    bands that repeat are only unpacked once.
+
+    With 'pages' (from 0), only those pages are rendered, going straight to
+    them through the index of the dump. With 'job', only that (offset,
+    length) job of a capture of many (see split_jobs).
+    """
+    if pages is None:
+        lexer = open_dump(path, job=job)
+        state = PrinterState()
+        first = 0
+        data = lexer.buf if job is None else lexer.buf[job[0]:]
+        options = ""
+    else:
+        lexer, state, pages = open_pages(path, pages)
+        first = pages.start
+        data = lexer.buf[lexer.pos:]
+        options = "pages {} {!r}".format(first, state)
+
+    if cache is not None:
+        options += " {} {} {} {}".format(format, level, scale, roi)
+        key = cache.key(data, options + (" planes" if planes else ""))
+        cached = cache.get(key)
+        trace(TRACE_SUMMARY, "Page cache: {} hits, {} misses", cache.hits, cache.misses,
+              file=sys.stderr)
+        if cached is not None:
+            copied = []
+            for name in cached:
+                copied.append("{}-{}".format(prefix, os.path.basename(name)))
+                shutil.copyfile(name, copied[-1])
+                trace(TRACE_SUMMARY, "{} copied from the cache", copied[-1],
+                      file=sys.stderr)
+
+            return copied
+
+    from epsonraster import BandCache, PageWriter
+
+    bandcache = BandCache() if cache is not None else None
+    written = []
+
+    extensions = [OUTPUT_FORMATS[format]]
+    if planes and format != "npy":
+        extensions.append(OUTPUT_FORMATS["npy"])
+
+    # The pages are new arrays, so the writer can keep them while we go on
+    with PageWriter(writers, level) as pagewriter:
+        rendered = render_pages(lexer, state, jobs, pagelimit, bandcache, scale, roi)
+        for pageno, page in enumerate(rendered, start=first+1):
+            for extension in extensions:
+                pagepath = "{}-{:04d}{}".format(prefix, pageno, extension)
+                pagewriter.write(page, pagepath, page_written)
+                written.append(pagepath)
+
+            del page
+
+    if cache is not None:
+        cache.put(key, written, prefix)
+        if jobs == 1:
+            trace(TRACE_SUMMARY, "Band cache: {} hits, {} misses", bandcache.hits,
+                  bandcache.misses, file=sys.stderr)
+
+    return written
+
+
+def find_dumps(patterns: list) -> list:
+    """
+    Return the dumps named by 'patterns': files, directories (their *.epson
+    files) or globs
+    """
+    dumps = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            dumps += sorted(glob.glob(os.path.join(glob.escape(pattern), "*.epson")))
+        elif glob.has_magic(pattern):
+            dumps += sorted(glob.glob(pattern, recursive=True))
+        else:
+            dumps.append(pattern)
+
+    return list(dict.fromkeys(dumps))
+
+
+def batch_prefix(path: str) -> str:
+    """
+    Where the pages of a dump go on a batch: next to it, named after it
+    """
+    return os.path.splitext(path)[0]
+
+
+def batch_outputs(path: str) -> list:
+    return glob.glob(glob.escape(batch_prefix(path)) + "-[0-9][0-9][0-9][0-9].*")
+
+
+# The batch options that change the files written for a dump
+BATCH_RENDER_OPTIONS = ("format", "level", "planes", "scale")
+
+
+def batch_render_path(path: str) -> str:
+    """
+    Where the options the pages of a dump were rendered with are kept, as
+    JSON, next to them
+    """
+    return batch_prefix(path) + ".render.json"
+
+
+def up_to_date(path: str, options: dict) -> bool:
+    """
+    Tell if the pages of a dump were rendered with the 'options' of this
+    batch, after it last changed
+    """
+    try:
+        with open(batch_render_path(path)) as rendered:
+            used = json.load(rendered)
+    except (OSError, ValueError):
+        return False
+
+    if used != {name: options[name] for name in BATCH_RENDER_OPTIONS}:
+        return False
+
+    pages = [name for name in batch_outputs(path)
+             if name.endswith(OUTPUT_FORMATS[options["format"]])]
+    if not pages:
+        return False
+
+    changed = os.stat(path).st_mtime_ns
+    return all(os.stat(page).st_mtime_ns >= changed
+               for page in pages + [batch_render_path(path)])
+
+
+# The options of the batch this worker renders
+batch_options = None
+
+
+def batch_init(options: dict, level: int):
+    """
+    Set up a batch worker, once: load the rasterizer and take the options
+    """
+    global batch_options
+    # Imported here only to load the rasterizer before the first job
+    import epsonraster  # noqa: F401
+
+    batch_options = options
+    set_trace(level)
+
+
+def batch_job(path: str) -> tuple[int, float, bool]:
+    """
+    Render a dump of a batch, on a worker. Returns how many pages it has,
+    how long it took, and if it was copied from the page cache.
+
+    The options the pages were rendered with are saved next to them (see
+    up_to_date). The pages of a dump that fails are removed, so it is not
+    taken as up to date on the next batch.
+    """
+    options = batch_options
+    cache = None
+    if options["cache"] is not None:
+        cache = PageCache(options["cache"], options["cachesize"])
+
+    start = time.perf_counter()
+    try:
+        written = render_dump(path, planes=options["planes"],
+                              pagelimit=options["pagelimit"], cache=cache,
+                              prefix=batch_prefix(path), format=options["format"],
+                              level=options["level"], writers=options["writers"],
+                              scale=options["scale"])
+        with open(batch_render_path(path), "w") as rendered:
+            json.dump({name: options[name] for name in BATCH_RENDER_OPTIONS}, rendered)
+    except Exception:
+        for name in batch_outputs(path) + glob.glob(glob.escape(batch_render_path(path))):
+            os.remove(name)
+
+        raise
+
+    pages = sum(1 for name in written if name.endswith(OUTPUT_FORMATS[options["format"]]))
+    return pages, time.perf_counter() - start, cache is not None and cache.hits > 0
+
+
+def render_batch(patterns: list, workers: Optional[int] = None, planes: bool = False,
+                 pagelimit: Optional[int] = None, cache: Optional[str] = None,
+                 cachesize: int = PAGE_CACHE_SIZE, force: bool = False,
+                 format: str = "png", level: Optional[int] = None,
+                 writers: int = 1, scale: int = 1):
+    """
+    Render every dump named by 'patterns', on 'workers' processes (by
+    default, one per CPU), each dump to pages next to it
+    (JOB.epson to JOB-0001.png...).
+
+    The dumps rendered with the same options after they last changed are
+    skipped, unless 'force'.
+    """
+    dumps = find_dumps(patterns)
+    options = dict(planes=planes, pagelimit=pagelimit, cache=cache, cachesize=cachesize,
+                   format=format, level=level, writers=writers, scale=scale)
+
+    todo = [path for path in dumps if force or not up_to_date(path, options)]
+    trace(TRACE_SUMMARY, "{} dumps, {} up to date", len(dumps), len(dumps) - len(todo),
+          file=sys.stderr)
+
+    # The workers only tell what each command does if asked for more than
+    # the summary; the summary of the batch is told here
+    level = trace_level if trace_level > TRACE_SUMMARY else TRACE_OFF
+
+    done = failed = hits = pages = size = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=batch_init,
+                             initargs=(options, level)) as executor:
+        futures = {executor.submit(batch_job, path): path for path in todo}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                count, elapsed, cached = future.result()
+            except Exception as e:
+                failed += 1
+                trace(TRACE_SUMMARY, "{}: failed: {}", path, e, file=sys.stderr)
+                continue
+
+            done += 1
+            hits += cached
+            pages += count
+            size += os.stat(path).st_size
+            trace(TRACE_SUMMARY, "{}: {} pages in {:.3f} s", path, count, elapsed,
+                  file=sys.stderr)
+
+    if cache is not None:
+        trace(TRACE_SUMMARY, "Page cache: {} hits, {} misses", hits, done - hits,
+              file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    rate = elapsed if elapsed > 0 else float("inf")
+    print("{} dumps rendered ({} pages, {:.1f} MB) in {:.3f} s: {:.2f} jobs/s, "
+          "{:.1f} MB/s; {} skipped, {} failed".format(
+              done, pages, size / 1e6, elapsed, done / rate, size / rate / 1e6,
+              len(dumps) - len(todo), failed))
+
+    return failed
+
+
+def render_capture(path: str, workers: Optional[int] = None, prefix: str = "out",
+                   planes: bool = False, pagelimit: Optional[int] = None,
+                   format: str = "png", level: Optional[int] = None,
+                   writers: int = 1, scale: int = 1,
+                   roi: Optional[tuple[int, int, int, int]] = None) -> int:
+    """
+    Split a capture of many print jobs (see split_jobs), and render each job
+    on 'workers' processes (by default, one per CPU), to
+    PREFIX-jobNNNN-0001.png...
+
+    Returns how many jobs failed.
+    """
+    start = time.perf_counter()
+    jobs = split_jobs(map_dump(path))
+    trace(TRACE_SUMMARY, "{}: {} jobs, split in {:.3f} s", path, len(jobs),
+          time.perf_counter() - start, file=sys.stderr)
+
+    # As on a batch, the workers only tell more than the summary
+    tracelevel = trace_level if trace_level > TRACE_SUMMARY else TRACE_OFF
+
+    done = failed = pages = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_trace,
+                             initargs=(tracelevel,)) as executor:
+        futures = {}
+        for jobno, job in enumerate(jobs, start=1):
+            future = executor.submit(render_dump, path, planes=planes, pagelimit=pagelimit,
+                                     prefix="{}-job{:04d}".format(prefix, jobno),
+                                     format=format, level=level, writers=writers,
+                                     scale=scale, roi=roi, job=job)
+            futures[future] = jobno, job
+
+        for future in as_completed(futures):
+            jobno, (offset, length) = futures[future]
+            try:
+                written = future.result()
+            except Exception as e:
+                failed += 1
+                trace(TRACE_SUMMARY, "job {} (at {}, {} bytes): failed: {}", jobno, offset,
+                      length, e, file=sys.stderr)
+                continue
+
+            done += 1
+            count = sum(1 for name in written if name.endswith(OUTPUT_FORMATS[format]))
+            pages += count
+            trace(TRACE_SUMMARY, "job {} (at {}, {} bytes): {} pages", jobno, offset,
+                  length, count, file=sys.stderr)
+
+    print("{} jobs rendered ({} pages) in {:.3f} s; {} failed".format(
+        done, pages, time.perf_counter() - start, failed))
+
+    return failed
+
+
+def inspect_job(lexer: CommandLexer, state: PrinterState) -> dict:
+    """
+    Run the commands from 'lexer' without drawing anything, and count what
+    the job has.
+
+    The pages are split by PageSplitter, as PageRenderer splits them.
+    """
+    commands = Counter()
+    bands = Counter()
+    pages = 0
+    splitter = PageSplitter(state)
+
+    # Band data on the stream, and what the compressed part decodes to
+    compressed = unpacked = uncompressed = 0
+
+    for event, cmd, state in splitter.events(lexer):
+        commands[cmd.name] += 1
+
+        if event == EVENT_PAGE:
+            pages += 1
+            continue
+
+        if event != EVENT_BAND:
+            continue
+
+        printinfo = state.printinfo
+        bands[printinfo["color"]] += 1
+        if printinfo["compress"] == 1:
+            compressed += cmd.received
+            unpacked += printinfo["toread"]
+        else:
+            uncompressed += cmd.received
+
+    if splitter.finish():
+        pages += 1
+
+    return dict(commands=commands, bands=bands, pages=pages,
+                compressed=compressed, unpacked=unpacked,
+                uncompressed=uncompressed)
+
+
+def inspect_dump(path: str, pages: Optional[range] = None):
+    """
+    Print what the dump of a print job has, without rendering it.
+
+    With 'pages' (from 0), only those pages are looked at.
+    """
+    start = time.perf_counter()
+    if pages is None:
+        lexer = open_dump(path, decode=False)
+        state = PrinterState()
+    else:
+        lexer, state, pages = open_pages(path, pages, decode=False)
+
+    first = lexer.tell()
+    summary = inspect_job(lexer, state)
+    elapsed = time.perf_counter() - start
+
+    size = lexer.tell() - first if pages is not None else lexer.tell()
+    print("{}: {} bytes in {:.3f} s ({:.1f} MB/s)".format(
+        path, size, elapsed, size / elapsed / 1e6 if elapsed > 0 else 0))
+    print("pages: {}".format(summary["pages"]))
+
+    print("commands: {}".format(sum(summary["commands"].values())))
+    for name, count in summary["commands"].most_common():
+        print("    {:<12} {}".format(repr(name), count))
+
+    print("bands: {}".format(sum(summary["bands"].values())))
+    for color, count in sorted(summary["bands"].items()):
+        print("    color {:<6} {}".format(color, count))
+
+    print("band data: {} bytes compressed (packbits, {} uncompressed), "
+          "{} bytes uncompressed".format(
+              summary["compressed"], summary["unpacked"], summary["uncompressed"]))
+
+
+@dataclass
+class PrinterSpeed:
+    """
+    How fast the printer moves, for estimate_job. The defaults are rough
+    guesses for an inkjet; time a page on your printer to get its own.
+    """
+    # Speed of the head, in inches per second
+    carriage: float = 30.0
+
+    # Speed of the paper feed, in inches per second
+    feed: float = 8.0
+
+    # Seconds each pass of the head takes besides moving (speeding up,
+    # slowing down, turning around)
+    pass_overhead: float = 0.05
+
+    # Seconds to load and eject each page
+    page_overhead: float = 2.0
+
+    # If the head prints both ways. A job that asks to print one way (the U
+    # command) is always printed one way.
+    bidirectional: bool = True
+
+
+def estimate_job(lexer: CommandLexer, state: PrinterState,
+                 speed: Optional[PrinterSpeed] = None) -> list:
+    """
+    Run the commands from 'lexer' without drawing anything, and estimate how
+    long a printer moving at 'speed' takes to print each page. Returns, for
+    each page, its passes of the head, how far the head and the paper
+    travel (in inches) and the seconds it takes.
+
+    The bands between two paper feeds are printed on one pass of the head,
+    over all of them. Printing one way, the head goes back to the left of
+    each pass before it; both ways, it starts from the end it is closest
+    to. The paper feeds are in vunits, and the head moves and band widths
+    in hunits (or in pageunits, before those are set).
+
+    The pages are split by PageSplitter, as PageRenderer splits them.
+    """
+    if speed is None:
+        speed = PrinterSpeed()
+
+    pages = []
+    passes = 0
+    carriage = paper = 0.0
+    splitter = PageSplitter(state)
+
+    # Where the head is, and the left and right of the pass it is on, in
+    # inches
+    head = 0.0
+    passleft = passright = None
+    top = state.headtop
+
+    def finish_pass():
+        nonlocal passes, carriage, head, passleft
+        if passleft is None:
+            return
+
+        start, end = passleft, passright
+        if (speed.bidirectional and not state.unidirectional and
+                abs(head - passright) < abs(head - passleft)):
+            start, end = passright, passleft
+
+        carriage += abs(head - start) + abs(end - start)
+        head = end
+        passes += 1
+        passleft = None
+
+    def finish_page():
+        seconds = (carriage / speed.carriage + paper / speed.feed +
+                   passes * speed.pass_overhead + speed.page_overhead)
+        pages.append(dict(passes=passes, carriage=carriage, paper=paper,
+                          seconds=seconds))
+
+    for event, cmd, state in splitter.events(lexer):
+        pageunit = state.pageunits or 1/360
+        vunit = state.vunits or pageunit
+        hunit = state.hunits or pageunit
+
+        if event in (EVENT_PAGE, EVENT_BLANK):
+            finish_pass()
+            if event == EVENT_PAGE:
+                finish_page()
+
+            passes = 0
+            carriage = paper = 0.0
+            top = state.headtop
+            continue
+
+        if state.headtop != top:
+            finish_pass()
+            paper += abs(state.headtop - top) * vunit
+            top = state.headtop
+
+        if event != EVENT_BAND:
+            continue
+
+        printinfo = state.printinfo
+        if printinfo["bpp"] == 0:
+            continue
+
+        left = state.headleft * hunit
+        right = left + printinfo["bytesline"] * 8 / printinfo["bpp"] * hunit
+        if passleft is None:
+            passleft, passright = left, right
+        else:
+            passleft = min(passleft, left)
+            passright = max(passright, right)
+
+    finish_pass()
+    if splitter.finish():
+        finish_page()
+
+    return pages
+
+
+def estimate_dump(path: str, pages: Optional[range] = None,
+                  speed: Optional[PrinterSpeed] = None):
+    """
+    Print how long the dump of a print job takes to print, by page, on a
+    printer moving at 'speed' (see estimate_job).
+
+    With 'pages' (from 0), only those pages are estimated.
+    """
+    start = time.perf_counter()
+    if pages is None:
+        lexer = open_dump(path, decode=False)
+        state = PrinterState()
+        first = 0
+    else:
+        lexer, state, pages = open_pages(path, pages, decode=False)
+        first = pages.start
+
+    estimates = estimate_job(lexer, state, speed)
+    elapsed = time.perf_counter() - start
+
+    print("{}: estimated in {:.3f} s".format(path, elapsed))
+    print("{:>6} {:>8} {:>12} {:>10} {:>10}".format("page", "passes", "head (in)",
+                                                   "paper (in)", "seconds"))
+    for pageno, page in enumerate(estimates, start=first+1):
+        print("{:>6} {:>8} {:>12.1f} {:>10.1f} {:>10.1f}".format(
+            pageno, page["passes"], page["carriage"], page["paper"], page["seconds"]))
+
+    seconds = round(sum(page["seconds"] for page in estimates))
+    print("total: {} pages, {} s ({}:{:02d}), the head travels {:.1f} m and "
+          "the paper {:.1f} m".format(
+              len(estimates), seconds, seconds // 60, seconds % 60,
+              sum(page["carriage"] for page in estimates) * 0.0254,
+              sum(page["paper"] for page in estimates) * 0.0254))
+
+
+def speed_model(text: str) -> PrinterSpeed:
+    """
+    Parse 'NAME=VALUE[,NAME=VALUE...]', with the fields of PrinterSpeed, for
+    argparse
+    """
+    values = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        kind = PrinterSpeed.__annotations__.get(name.strip())
+        try:
+            if kind is None:
+                raise ValueError
+            elif kind == "bool":
+                values[name.strip()] = value.strip().lower() in ("1", "yes", "true")
+            else:
+                values[name.strip()] = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("{!r} is not NAME=VALUE, with NAME one of {}".format(
+                item, ", ".join(PrinterSpeed.__annotations__)))
+
+    return PrinterSpeed(**values)
+
+
+def byte_range(text: str) -> tuple[int, int]:
+    """
+    Parse 'START[-END]' (both included) for argparse
+    """
+    start, _, end = text.partition("-")
+    try:
+        start = int(start, 0)
+        end = int(end, 0) if end else start
+    except ValueError:
+        raise argparse.ArgumentTypeError("{!r} is not START or START-END".format(text))
+
+    if start < 0 or end < start:
+        raise argparse.ArgumentTypeError("{!r} is not a range".format(text))
+
+    return start, end
+
+
+def rectangle(text: str) -> tuple[int, int, int, int]:
+    """
+    Parse 'LEFT,TOP,WIDTH,HEIGHT' for argparse, into (left, top, right,
+    bottom)
+    """
+    try:
+        left, top, width, height = (int(value, 0) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{!r} is not LEFT,TOP,WIDTH,HEIGHT".format(text))
+
+    if left < 0 or top < 0 or width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("{!r} is not a rectangle".format(text))
+
+    return left, top, left + width, top + height
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Emulate an Epson printer, rendering the pages of a dump "
+                    "of a print job to out-0001.png, out-0002.png...")
+    parser.add_argument("dump", nargs="*", default=["out.epson"],
+                        help="the dump of the print job (default: out.epson); "
+                             "with --batch, any number of dumps, directories "
+                             "or globs")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="rasterize each page on this many processes "
+                             "(default: 1); with --batch, render this many "
+                             "dumps at a time (default: one per CPU)")
+    parser.add_argument("--batch", action="store_true",
+                        help="render many dumps, each to pages next to it "
+                             "(JOB.epson to JOB-0001.png...), skipping the "
+                             "ones rendered after they last changed")
+    parser.add_argument("--force", action="store_true",
+                        help="with --batch, also render the dumps that are "
+                             "up to date")
+    parser.add_argument("--split", action="store_true",
+                        help="the dump is a capture of many jobs: split it, "
+                             "and render each job to out-jobNNNN-0001.png..., "
+                             "one per CPU (or -j N) at a time")
+    parser.add_argument("--page-memory", type=int, metavar="MB",
+                        help="draw pages bigger than this many MiB on a "
+                             "temporary file (default: 256)")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="keep the rendered jobs on DIR, and copy them "
+                             "from it when they are rendered again; bands "
+                             "that repeat are also only unpacked once (the "
+                             "only cache with --listen)")
+    parser.add_argument("--cache-size", type=int, metavar="MB",
+                        default=PAGE_CACHE_SIZE >> 20,
+                        help="how much disk the cache can take (default: "
+                             "{})".format(PAGE_CACHE_SIZE >> 20))
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="png",
+                        help="save the pages as png (the default), ppm or "
+                             "tiff (not compressed, faster to write) images, "
+                             "or as npy, the C, M, Y and K coverage planes")
+    parser.add_argument("--png-level", type=int, choices=range(10), metavar="0-9",
+                        help="how much the PNG images are compressed, from 0 "
+                             "(not at all) to 9 (default: 6)")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="write the pages on this many threads, while the "
+                             "next ones are rendered; 0 writes each page "
+                             "before going on (default: 1)")
+    parser.add_argument("--preview", type=int, choices=(2, 4, 8), metavar="N",
+                        help="render previews, N (2, 4 or 8) times smaller "
+                             "on each side")
+    parser.add_argument("--roi", type=rectangle, metavar="LEFT,TOP,WIDTH,HEIGHT",
+                        help="only render this rectangle of the pages, in "
+                             "dots (pageunits), skipping the bands that do "
+                             "not land on it")
+    parser.add_argument("--planes", action="store_true",
+                        help="also save the C, M, Y and K ink coverage of each "
+                             "page, as numpy arrays (out-0001.npy...)")
+    parser.add_argument("--inspect", action="store_true",
+                        help="only tell what the dump has (commands, pages, "
+                             "bands), without rendering it")
+    parser.add_argument("--estimate", action="store_true",
+                        help="only estimate how long each page takes to "
+                             "print, and how far the head and the paper "
+                             "travel, without rendering")
+    parser.add_argument("--speed", type=speed_model, metavar="NAME=VALUE,...",
+                        help="how fast the printer is, for --estimate: "
+                             "carriage and feed (inches per second), "
+                             "pass_overhead and page_overhead (seconds), "
+                             "bidirectional (1 or 0)")
+    parser.add_argument("--pages", type=byte_range, metavar="N[-M]",
+                        help="only render (or inspect) pages N to M, going "
+                             "straight to them through the index of the dump")
+    parser.add_argument("--bytes", type=byte_range, metavar="START[-END]",
+                        help="only render (or inspect) the pages with the "
+                             "bytes from START to END")
+    parser.add_argument("--index", action="store_true",
+                        help="only tell where each page of the dump is; the "
+                             "index is kept on DUMP.idx, and made again when "
+                             "the dump changes")
+    parser.add_argument("--listen", action="store_true",
+                        help="instead of reading a dump, listen on the printer "
+                             "port and render the jobs as they arrive")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1; "
+                             "0.0.0.0 takes jobs from any machine)")
+    parser.add_argument("--port", type=int, default=9100,
+                        help="port to listen on (default: 9100)")
+    parser.add_argument("--trace", choices=TRACE_LEVELS, default="summary",
+                        help="how much to tell about what the printer does: "
+                             "off, summary (the default), commands or bytes")
+    parser.add_argument("--trace-file", metavar="PATH",
+                        help="write each command to PATH, as JSON lines with "
+                             "its offset, name and parameters")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="tell where the time went, by command, band and "
+                             "page, and save it to PATH: as JSON if it ends "
+                             "with .json, or else as folded stacks, for "
+                             "flame graphs (not with --batch)")
+    args = parser.parse_args()
+
+    if len(args.dump) > 1 and not args.batch:
+        parser.error("only one dump can be rendered, without --batch")
+    dump = args.dump[0]
+    jobs = args.jobs if args.jobs is not None or args.batch else 1
+
+    pagelimit = args.page_memory << 20 if args.page_memory is not None else None
+
+    pages = None
+    if args.pages is not None:
+        if args.pages[0] < 1:
+            parser.error("the pages start at 1")
+        pages = range(args.pages[0] - 1, args.pages[1])
+
+    sink = open(args.trace_file, "w") if args.trace_file is not None else None
+    set_trace(TRACE_LEVELS[args.trace], sink)
+
+    if args.profile is not None:
+        set_profiler(Profiler())
+
+    try:
+        if args.listen:
+            try:
+                import asyncio
+                asyncio.run(serve(args.host, args.port, "out", jobs,
+                                  pagelimit, args.cache is not None,
+                                  args.format, args.png_level, args.writers))
+            except KeyboardInterrupt:
+                pass
+        elif args.batch:
+            failed = render_batch(args.dump, jobs, args.planes, pagelimit, args.cache,
+                                  args.cache_size << 20, args.force, args.format,
+                                  args.png_level, args.writers, args.preview or 1)
+            if failed > 0:
+                sys.exit(1)
+        elif args.split:
+            failed = render_capture(dump, args.jobs, planes=args.planes,
+                                    pagelimit=pagelimit, format=args.format,
+                                    level=args.png_level, writers=args.writers,
+                                    scale=args.preview or 1, roi=args.roi)
+            if failed > 0:
+                sys.exit(1)
+        elif args.index:
+            list_index(dump)
+        else:
+            if args.bytes is not None:
+                index = load_index(dump)
+                first = max(index.page_at(args.bytes[0]), 0)
+                pages = range(first, index.page_at(args.bytes[1]) + 1)
+
+            if args.inspect:
+                inspect_dump(dump, pages)
+            elif args.estimate:
+                estimate_dump(dump, pages, args.speed)
+            else:
+                cache = None
+                if args.cache is not None:
+                    cache = PageCache(args.cache, args.cache_size << 20)
+
+                render_dump(dump, jobs, args.planes, pagelimit, cache, pages,
+                            format=args.format, level=args.png_level,
+                            writers=args.writers, scale=args.preview or 1,
+                            roi=args.roi)
+    except EOFError as e:
+        # A dump that is empty, without the preamble, or shorter than the
+        # pages asked for
+        sys.exit(str(e))
+    finally:
+        if sink is not None:
+            sink.close()
+
+        if profiler is not None:
+            profiler.report()
+            with open(args.profile, "w") as out:
+                if args.profile.endswith(".json"):
+                    profiler.write_json(out)
+                else:
+                    profiler.write_folded(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -279,7 +279,7 @@ class TestPrintJob():
 
         import sys
         
-        tpj.add_metadata_commands()
+        self.add_metadata_commands()
         width = 800
         height = 600
 #        im = Image.new("RGB", (width, height), (60, 255, 90))
@@ -529,28 +529,29 @@ class TestPrintJob():
         return b"\x00\x00\x00\x1b\x01@EJL 1284.4\n@EJL     \n\x1b@"
 
 
-arr = [1, 1, 1, 2, 2, 2, 3, 3, 3, 3]
-arr.extend(129*[0])
-arr.extend(150*[3])
+if __name__ == "__main__":
+    arr = [1, 1, 1, 2, 2, 2, 3, 3, 3, 3]
+    arr.extend(129*[0])
+    arr.extend(150*[3])
 
-print(repr(pack_byte_encode(arr)))
+    print(repr(pack_byte_encode(arr)))
 
-addr = "127.0.0.1"
-#addr = "192.168.1.237"
-#name = identify_printer(addr)
-#if name is None:
-#    print("Printer not found. Please check printer port")
-#    print("(Autodetection not yet supported :( )")
-#    sys.exit(1)
+    addr = "127.0.0.1"
+    #addr = "192.168.1.237"
+    #name = identify_printer(addr)
+    #if name is None:
+    #    print("Printer not found. Please check printer port")
+    #    print("(Autodetection not yet supported :( )")
+    #    sys.exit(1)
 
-# print(f"Detected printer '{name}'")
+    # print(f"Detected printer '{name}'")
 
-tpj = TestPrintJob(addr, 360)
-tpj.create_test_page()
+    tpj = TestPrintJob(addr, 360)
+    tpj.create_test_page()
 
-bufsize = len(tpj.buffer)
-print(f"Buffer gerado ({bufsize} bytes)")
-print("Hora da verdade!")
+    bufsize = len(tpj.buffer)
+    print(f"Buffer gerado ({bufsize} bytes)")
+    print("Hora da verdade!")
 
-tpj.send_buffer()
-print("Vai lá ver se deu certo! É pra imprimir uma linha de cada cor.")
+    tpj.send_buffer()
+    print("Vai lá ver se deu certo! É pra imprimir uma linha de cada cor.")
@@ -0,0 +1,215 @@
+"""
+Regression tests of the printer emulator.
+
+Renders a fixed set of jobs (made up with benchmark.SyntheticJob, plus the
+captured dumps on a directory) and compares each page with a golden image
+rendered before, by a version we trust. Each job is rendered serially, in
+parallel, with a cold band cache and again with the same cache, warm, and
+each render has a time budget.
+
+Run it with --update, on a version whose pages are right, to write the
+golden images.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmark import SyntheticJob
+from epsonraster import BandCache
+from epsonserver import TRACE_OFF, RenderOptions, render_job, set_trace
+
+
+# The made up jobs, and what SyntheticJob makes them with
+GENERATED = {
+    "blank": dict(pages=1, bands=16, content="blank"),
+    "mixed": dict(pages=2, bands=64, content="mixed", seed=1),
+    "noisy-uncompressed": dict(pages=1, bands=32, content="noisy",
+                               compress=False, seed=2),
+    "mixed-720dpi": dict(pages=1, bands=64, dpi=720, content="mixed", seed=3),
+    "mixed-180dpi": dict(pages=1, bands=64, dpi=180, content="mixed", seed=4),
+}
+
+# The ways each job is rendered: its options, given the band cache of the
+# job (new for each job, so "cached-warm" gets the bands of "cached")
+MODES = {
+    "serial": lambda cache: RenderOptions(),
+    "parallel": lambda cache: RenderOptions(jobs=2),
+    "cached": lambda cache: RenderOptions(bandcache=cache),
+    "cached-warm": lambda cache: RenderOptions(bandcache=cache),
+}
+
+
+def corpus(captures: str) -> dict:
+    """
+    Return the jobs to render, by name: the made up ones, and the *.epson
+    files on 'captures'
+    """
+    jobs = {name: SyntheticJob(**args).buffer for name, args in GENERATED.items()}
+
+    for path in sorted(glob.glob(os.path.join(glob.escape(captures), "*.epson"))):
+        with open(path, "rb") as dump:
+            jobs[os.path.splitext(os.path.basename(path))[0]] = dump.read()
+
+    return jobs
+
+
+def diff_pages(page: np.ndarray, golden: np.ndarray) -> str:
+    """
+    Compare two RGB pages. Returns what differs, or an empty string if they
+    are the same.
+    """
+    if page.shape != golden.shape:
+        return "size is {}x{}, not {}x{}".format(page.shape[1], page.shape[0],
+                                                 golden.shape[1], golden.shape[0])
+
+    differs = np.any(page != golden, axis=2)
+    rows = np.flatnonzero(differs.any(axis=1))
+    if len(rows) == 0:
+        return ""
+
+    cols = np.flatnonzero(differs.any(axis=0))
+    delta = np.abs(page.astype(np.int16) - golden)
+    return "{} pixels differ, in ({}, {})-({}, {}), by up to {}".format(
+        np.count_nonzero(differs), cols[0], rows[0], cols[-1], rows[-1],
+        delta.max())
+
+
+def golden_path(golden: str, name: str, pageno: int) -> str:
+    return os.path.join(golden, "{}-{:04d}.png".format(name, pageno))
+
+
+def check_job(name: str, mode: str, job: bytes, options: RenderOptions,
+              golden: str, budget: float) -> list:
+    """
+    Render 'job' and compare its pages with the golden ones. Returns what
+    went wrong.
+    """
+    errors = []
+    pages = 0
+
+    # The comparisons do not count on the budget
+    comparing = 0
+    start = time.perf_counter()
+    for page in render_job(job, options):
+        pages += 1
+        compared = time.perf_counter()
+        path = golden_path(golden, name, page.number)
+        if not os.path.exists(path):
+            errors.append("page {}: no golden image".format(page.number))
+            comparing += time.perf_counter() - compared
+            continue
+
+        with Image.open(path) as image:
+            expected = np.asarray(image.convert("RGB"))
+
+        diff = diff_pages(np.asarray(page.image()), expected)
+        if diff:
+            errors.append("page {}: {}".format(page.number, diff))
+
+        comparing += time.perf_counter() - compared
+
+    elapsed = time.perf_counter() - start - comparing
+
+    if os.path.exists(golden_path(golden, name, pages + 1)):
+        errors.append("only {} pages rendered".format(pages))
+
+    if elapsed > budget:
+        errors.append("took {:.3f} s, over the budget of {:.3f} s".format(elapsed, budget))
+
+    print("{:<24} {:<12} {:>3} pages {:>8.3f} s  {}".format(
+        name, mode, pages, elapsed, "FAIL" if errors else "ok"))
+    return errors
+
+
+def update_job(name: str, job: bytes, golden: str):
+    """
+    Write the golden images of 'job', dropping the ones of pages it does not
+    have anymore
+    """
+    for path in glob.glob(glob.escape(os.path.join(golden, name)) + "-[0-9][0-9][0-9][0-9].png"):
+        os.remove(path)
+
+    pages = 0
+    for page in render_job(job):
+        page.image().save(golden_path(golden, name, page.number))
+        pages += 1
+
+    print("{:<24} {:>3} pages written".format(name, pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render the regression jobs, and compare their pages "
+                    "with the golden images")
+    parser.add_argument("--golden", default="golden",
+                        help="directory of the golden images (default: golden)")
+    parser.add_argument("--captures", default="captures",
+                        help="directory with captured dumps (*.epson) to "
+                             "render too (default: captures)")
+    parser.add_argument("--budget", type=float, default=10.0,
+                        help="seconds each job can take to render, on each "
+                             "mode (default: 10)")
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="how to render each job, out of {} (default: "
+                             "all)".format(", ".join(MODES)))
+    parser.add_argument("--update", action="store_true",
+                        help="write the golden images, instead of comparing "
+                             "with them")
+    parser.add_argument("jobs", nargs="*",
+                        help="only these jobs (default: all)")
+    args = parser.parse_args()
+
+    set_trace(TRACE_OFF)
+
+    jobs = corpus(args.captures)
+    if args.jobs:
+        missing = set(args.jobs) - set(jobs)
+        if missing:
+            parser.error("unknown jobs: {}".format(", ".join(sorted(missing))))
+
+        jobs = {name: jobs[name] for name in args.jobs}
+
+    if args.update:
+        os.makedirs(args.golden, exist_ok=True)
+        for name, job in jobs.items():
+            update_job(name, job, args.golden)
+
+        return
+
+    modes = args.modes.split(",")
+    if not set(modes) <= set(MODES):
+        parser.error("the modes are {}".format(", ".join(MODES)))
+
+    failures = 0
+    for name, job in jobs.items():
+        cache = BandCache()
+        for mode in modes:
+            if mode == "cached-warm" and cache.misses == 0:
+                # Not warmed by a "cached" render before
+                for _ in render_job(job, RenderOptions(bandcache=cache)):
+                    pass
+
+            hits = cache.hits
+            errors = check_job(name, mode, job, MODES[mode](cache), args.golden,
+                               args.budget)
+            if mode == "cached-warm" and cache.hits == hits:
+                errors.append("no band came from the cache")
+
+            for error in errors:
+                print("    {}: {}".format(mode, error))
+
+            failures += len(errors) > 0
+
+    print("{} renders failed".format(failures))
+    if failures > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
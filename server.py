@@ -5,19 +5,22 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
     s.listen()
     print("listening to 0.0.0.0:9100")
 
-    conn, addr = s.accept()
-    with conn:
-        print("job accepted!")
-        count = 1
-        
-        with open("out.epson", "wb") as out:    
-            while count > 0:
-                msg = conn.recv(10240)
+    # out.epson starts empty, and each job is added to the end of it, so it
+    # keeps all the jobs of this run (epsonserver.py --split renders each one)
+    open("out.epson", "wb").close()
+    while True:
+        conn, addr = s.accept()
+        with conn:
+            print("job accepted!")
+            count = 1
 
-                print("Receiving message")
-                
-                count = len(msg)
-                out.write(msg)
+            with open("out.epson", "ab") as out:
+                while count > 0:
+                    msg = conn.recv(10240)
 
-            print("Received everything.")
-        
+                    print("Receiving message")
+
+                    count = len(msg)
+                    out.write(msg)
+
+                print("Received everything.")